@@ -1,24 +1,38 @@
 # app.py
 
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, session, send_from_directory, Response, g, abort
 import os
 import json
 import shutil
 from werkzeug.utils import secure_filename
 import datetime
 import threading
+import time
 import logging
 from pathlib import Path
+from typing import NamedTuple
 from dotenv import load_dotenv
 import uuid
 import re
+import functools
+import hmac
+import hashlib
+from urllib.parse import quote
+
+# Shared JSON (de)serialization (orjson when available)
+from json_utils import (
+    append_json_lines, dumps, loads, locked, read_json, read_json_lines, write_json,
+    write_json_lines
+)
 
 # Import the file processor module
-from file_processor import process_agent_files
+from file_processor import (
+    process_agent_files, notify_status_change, get_status_version, wait_for_status_change
+)
 
 # Import our prompt analyzer and retrieval logic
 from prompt_analyzer import analyze_prompt_with_gemini, perform_retrieval_for_analysis
-from retrieval_engine import save_retrieval_results
+from retrieval_engine import load_retrieval_results, save_retrieval_results
 
 # Try to import Gemini for final LLM calls
 try:
@@ -27,6 +41,13 @@ try:
 except ImportError:
     HAS_GEMINI = False
 
+# Try to import Flask-Compress for gzip/brotli-encoded responses
+try:
+    from flask_compress import Compress
+    HAS_COMPRESS = True
+except ImportError:
+    HAS_COMPRESS = False
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -36,113 +57,460 @@ load_dotenv()
 app = Flask(__name__)
 app.secret_key = 'your_secret_key_change_this_in_production'  # Change in production
 
+# Compress JSON and page responses when Flask-Compress is installed. Content-Encoding
+# is negotiated in an after_request hook, i.e. on the bytes _json() already produced.
+# Streamed responses (the processing-status SSE feed) are left alone so events
+# aren't held back in the compressor's buffer.
+if HAS_COMPRESS:
+    app.config.update(
+        COMPRESS_MIMETYPES=['application/json', 'text/html', 'text/css', 'application/javascript'],
+        COMPRESS_LEVEL=6,
+        COMPRESS_STREAMS=False,
+    )
+    Compress(app)
+
 # Base directory for data storage
-DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+# (override with ZAPIENT_DATA_DIR, e.g. a shared volume when running several workers)
+DATA_DIR = os.environ.get('ZAPIENT_DATA_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 
 # Create data directory if it doesn't exist
-if not os.path.exists(DATA_DIR):
-    os.makedirs(DATA_DIR)
+os.makedirs(DATA_DIR, exist_ok=True)
+
+# Buffer size used when streaming uploaded files to disk
+UPLOAD_COPY_BUFSIZE = 1024 * 1024
+
+# Processing-status SSE: how often an idle stream rechecks the files on disk,
+# and how long a stream lives before the client reconnects. Each open stream holds
+# a server thread, so a stream also ends as soon as no file is pending or processing;
+# EventSource then reconnects after STATUS_STREAM_RETRY_MS to look for new work
+STATUS_STREAM_RECHECK_SECONDS = 15
+STATUS_STREAM_MAX_SECONDS = 300
+STATUS_STREAM_RETRY_MS = 5000
+
+# Browser cache lifetime (seconds) for downloaded uploads; revalidated via ETag afterwards
+UPLOAD_CACHE_MAX_AGE = 3600
+UPLOAD_CACHE_CONTROL = f"private, max-age={UPLOAD_CACHE_MAX_AGE}"
+
+# Offload uploaded-file downloads to the front-end web server when deployed behind one:
+#   ZAPIENT_SENDFILE=apache -> X-Sendfile (mod_xsendfile)
+#   ZAPIENT_SENDFILE=nginx  -> X-Accel-Redirect to an `internal;` location aliased to DATA_DIR
+# Unset (dev mode) streams the file through Flask via send_from_directory.
+SENDFILE_MODE = os.environ.get('ZAPIENT_SENDFILE', '').lower()
+ACCEL_REDIRECT_PREFIX = os.environ.get('ZAPIENT_ACCEL_PREFIX', '/protected').rstrip('/')
+app.use_x_sendfile = SENDFILE_MODE == 'apache'
 
 # Valid users for demo purposes (in a real app, you'd use a proper database)
 VALID_USERS = [
     {"username": "admin", "password": "admin"},
     {"username": "test", "password": "test"}
 ]
+VALID_USERS_BY_NAME = {u['username']: u['password'] for u in VALID_USERS}
 
 ########################
-# files.json Management
+# JSON Helpers
 ########################
 
-def create_files_json(username, agent_name):
-    """Create an initial empty files.json for an agent"""
-    agent_dir = os.path.join(DATA_DIR, username, 'AGENTS', agent_name)
-    files_json_path = os.path.join(agent_dir, 'files.json')
-    
-    files_data = {"files": []}
-    
-    with open(files_json_path, 'w') as f:
-        json.dump(files_data, f, indent=2)
-    
-    return files_data
+def _json(payload, status=200):
+    """Build a JSON response, serialized with orjson when available"""
+    return Response(dumps(payload), status=status, mimetype='application/json')
 
-def get_files_json(username, agent_name):
-    """Get (or create) files.json for an agent"""
-    agent_dir = os.path.join(DATA_DIR, username, 'AGENTS', agent_name)
-    files_json_path = os.path.join(agent_dir, 'files.json')
-    
-    if not os.path.exists(files_json_path):
-        return create_files_json(username, agent_name)
-    
-    try:
-        with open(files_json_path, 'r') as f:
-            return json.load(f)
-    except json.JSONDecodeError:
-        return create_files_json(username, agent_name)
+def _make_etag(parts):
+    return hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=8).hexdigest()
 
-def update_file_status(username, agent_name, filename, status, message=None):
-    """Update the status of a file in files.json"""
-    files_data = get_files_json(username, agent_name)
-    file_found = False
-    
-    for file in files_data['files']:
-        if file['name'] == filename:
-            file['processing_status'] = status
-            file['error_message'] = message if message else None
-            if status == 'success':
-                file['processed'] = True
-            file_found = True
-            break
-    
-    if not file_found:
-        logging.warning(f"File {filename} not found in files.json for agent {agent_name}")
-    
-    agent_dir = os.path.join(DATA_DIR, username, 'AGENTS', agent_name)
-    files_json_path = os.path.join(agent_dir, 'files.json')
-    
-    with open(files_json_path, 'w') as f:
-        json.dump(files_data, f, indent=2)
-    
-    return files_data
+def _etag_requested(etag):
+    """
+    Whether the request's If-None-Match covers `etag`. Flask-Compress sends the tag
+    of a compressed body as "<etag>:<algorithm>" and clients echo that back, so the
+    suffix is ignored (a conditional GET compares weakly anyway).
+    """
+    if_none_match = request.if_none_match
+    return if_none_match.star_tag or any(
+        tag.split(':', 1)[0] == etag for tag in if_none_match.as_set(include_weak=True)
+    )
 
-def add_file_to_json(username, agent_name, file_info):
-    """Add or update a file in files.json"""
-    files_data = get_files_json(username, agent_name)
-    for file in files_data['files']:
-        if file['name'] == file_info['name']:
-            file.update(file_info)
-            break
+def _json_conditional(payload, etag):
+    """
+    JSON response tagged with `etag`; answers 304 when the client already has it.
+    no-cache makes the browser revalidate on every poll instead of guessing freshness.
+    """
+    if _etag_requested(etag):
+        response = Response(status=304)
     else:
-        files_data['files'].append(file_info)
+        response = _json(payload)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+########################
+# Auth Guard
+########################
+
+def login_required(api=False):
+    """
+    Route decorator that rejects unauthenticated requests.
+    API routes get a JSON 401; page routes are redirected to the login page.
+    The logged-in user is bound to g.username for the handler.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            username = session.get('username')
+            if not username:
+                if api:
+                    return _json({"error": "Not authenticated"}, 401)
+                return redirect(url_for('login'))
+            g.username = username
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+########################
+# Path Helpers
+########################
+
+@functools.lru_cache(maxsize=1024)
+def _user_agents_dir(username):
+    """Return the AGENTS directory for a user (usernames never move, so this is cached)"""
+    return os.path.join(DATA_DIR, username, 'AGENTS')
+
+ALLOWED_EXTENSIONS = frozenset({'pdf'})
+
+# Agent names double as directory names. \Z rather than $ so a trailing newline is rejected.
+_AGENT_NAME_RE = re.compile(r'^[a-zA-Z0-9_\- ]+\Z')
+
+def _allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+@app.url_value_preprocessor
+def _reject_unsafe_agent_names(endpoint, values):
+    """
+    Every <agent_name> becomes a path component under the user's AGENTS dir, so names
+    that could never have been created (e.g. '..') are refused before any handler runs.
+    """
+    if values and 'agent_name' in values and not _AGENT_NAME_RE.match(values['agent_name']):
+        abort(_json({"error": "Agent not found"}, 404))
+
+# Names secure_filename() would return unchanged: only safe characters, and no
+# leading/trailing '.' or '_' (which it strips)
+_SAFE_FILENAME_RE = re.compile(r'^[A-Za-z0-9-](?:[A-Za-z0-9._-]*[A-Za-z0-9-])?\Z')
+
+@functools.lru_cache(maxsize=4096)
+def _secure_filename(filename):
+    """secure_filename() with a fast path for already-safe names, memoized across requests"""
+    if os.name != 'nt' and _SAFE_FILENAME_RE.match(filename):
+        return filename
+    return secure_filename(filename)
+
+class AgentPaths(NamedTuple):
+    agent_dir: str
+    uploads_dir: str
+    processed_dir: str
+    config_file: str
+    files_log: str
+    chat_log: str
+    retrieval_file: str
+
+@functools.lru_cache(maxsize=4096)
+def _agent_paths(username, agent_name):
+    """All on-disk locations for one agent, built once and reused across requests"""
+    agent_dir = os.path.join(_user_agents_dir(username), agent_name)
+    return AgentPaths(
+        agent_dir=agent_dir,
+        uploads_dir=os.path.join(agent_dir, 'uploads'),
+        processed_dir=os.path.join(agent_dir, 'processed'),
+        config_file=os.path.join(agent_dir, 'config.json'),
+        files_log=os.path.join(agent_dir, 'files.jsonl'),
+        chat_log=os.path.join(agent_dir, 'chat_history.jsonl'),
+        retrieval_file=os.path.join(agent_dir, 'retrieval_results.jsonl'),
+    )
+
+def _is_pdf(name):
+    """Case-insensitive '.pdf' suffix check that only lowercases the last 4 characters"""
+    return name[-4:].lower() == '.pdf'
+
+########################
+# files.jsonl Management
+########################
+
+# files.jsonl is an append-only log of file records for an agent. Each line is either
+# a full/partial record merged into the entry with the same "name" (last write wins)
+# or a {"name": ..., "deleted": true} tombstone. The log is compacted when it has
+# grown well past the number of live entries.
+FILES_LOG_COMPACT_MIN_LINES = 64
+
+# Folded file index per agent: (username, agent_name) -> ((ino, mtime_ns, size), {name: file}, line_count).
+# The stat stamp also catches appends made by the background processing workers; when the
+# log has only grown since it was cached, just the appended tail is read and folded in.
+_files_json_cache = {}
+_files_json_cache_lock = threading.Lock()
+
+def _files_log_path(username, agent_name):
+    return _agent_paths(username, agent_name).files_log
+
+def _stat_stamp(path):
+    st = os.stat(path)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _apply_file_record(index, record):
+    """Fold one files.jsonl record into a name -> file index"""
+    name = record['name']
+    if record.get('deleted'):
+        index.pop(name, None)
+    elif name in index:
+        index[name].update(record)
+    else:
+        index[name] = dict(record)
+
+def _fold_file_records(records):
+    index = {}
+    for record in records:
+        _apply_file_record(index, record)
+    return index
+
+def _copy_index(index):
+    """Copy a folded index deep enough that callers can mutate file entries freely"""
+    return {name: dict(f) for name, f in index.items()}
+
+def _invalidate_files_json(username, agent_name):
+    with _files_json_cache_lock:
+        _files_json_cache.pop((username, agent_name), None)
+
+def _ensure_files_log(username, agent_name):
+    """Make sure files.jsonl exists, converting a pre-JSON-Lines files.json if there is one"""
+    log_path = _files_log_path(username, agent_name)
+    legacy_path = os.path.join(_agent_paths(username, agent_name).agent_dir, 'files.json')
+    with locked(log_path):
+        if os.path.exists(log_path):
+            return
+        try:
+            legacy_files = read_json(legacy_path).get('files', [])
+        except FileNotFoundError:
+            legacy_files = None
+        except json.JSONDecodeError:
+            legacy_files = []
+        write_json_lines(log_path, legacy_files or [])
+        if legacy_files is not None:
+            os.remove(legacy_path)
+
+def _compact_files_log(username, agent_name):
+    """Rewrite files.jsonl with one record per live file"""
+    log_path = _files_log_path(username, agent_name)
+    with locked(log_path):
+        index = _fold_file_records(read_json_lines(log_path))
+        write_json_lines(log_path, list(index.values()))
+        stamp = _stat_stamp(log_path)
+    with _files_json_cache_lock:
+        _files_json_cache[(username, agent_name)] = (stamp, index, len(index))
+
+def _append_file_records(username, agent_name, records):
+    """Append records to files.jsonl and fold them into the cached index when it is current"""
+    log_path = _files_log_path(username, agent_name)
+    if not os.path.exists(log_path):
+        _ensure_files_log(username, agent_name)
+    key = (username, agent_name)
+    with locked(log_path):
+        try:
+            before = _stat_stamp(log_path)
+        except FileNotFoundError:
+            before = None
+        append_json_lines(log_path, records)
+        after = _stat_stamp(log_path)
+        with _files_json_cache_lock:
+            cached = _files_json_cache.get(key)
+            if cached and cached[0] == before:
+                _, index, line_count = cached
+                for record in records:
+                    _apply_file_record(index, record)
+                _files_json_cache[key] = (after, index, line_count + len(records))
+            else:
+                _files_json_cache.pop(key, None)
+    notify_status_change(username, agent_name)
+
+def _extend_cached_index(key, cached, log_path, stamp):
+    """
+    Fold the lines appended to files.jsonl since `cached` was taken into it.
+    Only possible when the log is the same file and has grown by whole lines;
+    returns False when a full re-read is needed. Caller holds _files_json_cache_lock.
+    """
+    (ino, _, size), index, line_count = cached
+    if stamp[0] != ino or stamp[2] <= size:
+        return False
+    with open(log_path, 'rb') as f:
+        # Both ends must sit on line boundaries: the cached size may have been
+        # taken mid-append, and an append may still be in flight now
+        for offset in (size, stamp[2]):
+            if offset:
+                f.seek(offset - 1)
+                if f.read(1) != b'\n':
+                    return False
+    records = read_json_lines(log_path, size, stamp[2])
+    for record in records:
+        _apply_file_record(index, record)
+    _files_json_cache[key] = (stamp, index, line_count + len(records))
+    return True
+
+def create_files_json(username, agent_name):
+    """Create an initial empty files.jsonl for an agent"""
+    log_path = _files_log_path(username, agent_name)
+    with locked(log_path):
+        # An empty log has nothing to lose in a crash (and _ensure_files_log recreates a
+        # missing one), so plain truncate-on-open is enough: no temp file, fsync or rename
+        os.close(os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644))
+        stamp = _stat_stamp(log_path)
+    with _files_json_cache_lock:
+        _files_json_cache[(username, agent_name)] = (stamp, {}, 0)
+    return {"files": []}
+
+def get_files_index(username, agent_name):
+    """Get (or create) an agent's files as a {name: file_info} dict for O(1) lookups"""
+    log_path = _files_log_path(username, agent_name)
     
-    agent_dir = os.path.join(DATA_DIR, username, 'AGENTS', agent_name)
-    files_json_path = os.path.join(agent_dir, 'files.json')
+    try:
+        stamp = _stat_stamp(log_path)
+    except FileNotFoundError:
+        _ensure_files_log(username, agent_name)
+        stamp = _stat_stamp(log_path)
     
-    with open(files_json_path, 'w') as f:
-        json.dump(files_data, f, indent=2)
+    key = (username, agent_name)
+    with _files_json_cache_lock:
+        cached = _files_json_cache.get(key)
+        if cached and cached[0] == stamp:
+            _, index, line_count = cached
+            files_index = _copy_index(index)
+        elif cached and _extend_cached_index(key, cached, log_path, stamp):
+            _, index, line_count = _files_json_cache[key]
+            files_index = _copy_index(index)
+        else:
+            cached = None
     
-    return files_data
+    if cached is None:
+        records = read_json_lines(log_path)
+        index = _fold_file_records(records)
+        line_count = len(records)
+        with _files_json_cache_lock:
+            _files_json_cache[key] = (stamp, index, line_count)
+            files_index = _copy_index(index)
+    
+    if line_count > max(FILES_LOG_COMPACT_MIN_LINES, 2 * len(files_index)):
+        _compact_files_log(username, agent_name)
+    return files_index
+
+def get_files_json(username, agent_name):
+    """Get (or create) the file list for an agent as {"files": [...]}"""
+    return {"files": list(get_files_index(username, agent_name).values())}
+
+def add_files_to_json(username, agent_name, file_infos):
+    """Add or update several files in files.jsonl with a single append"""
+    _append_file_records(username, agent_name, file_infos)
 
 def remove_file_from_json(username, agent_name, filename):
-    """Remove a file from files.json"""
-    files_data = get_files_json(username, agent_name)
-    files_data['files'] = [f for f in files_data['files'] if f['name'] != filename]
-    
-    agent_dir = os.path.join(DATA_DIR, username, 'AGENTS', agent_name)
-    files_json_path = os.path.join(agent_dir, 'files.json')
-    
-    with open(files_json_path, 'w') as f:
-        json.dump(files_data, f, indent=2)
-    
-    return files_data
+    """Remove a file from files.jsonl by appending a tombstone"""
+    _append_file_records(username, agent_name, [{"name": filename, "deleted": True}])
+
+########################
+# config.json Cache
+########################
+
+# Parsed config.json per agent: (username, agent_name) -> ((mtime_ns, size), config)
+_config_cache = {}
+_config_cache_lock = threading.Lock()
+
+def _read_agent_config_stamped(username, agent_name):
+    """Return (config, (mtime_ns, size)) for an agent's config.json"""
+    config_file = _agent_paths(username, agent_name).config_file
+    stamp = _stat_stamp(config_file)
+    key = (username, agent_name)
+    with _config_cache_lock:
+        cached = _config_cache.get(key)
+    if cached and cached[0] == stamp:
+        return dict(cached[1]), stamp
+
+    config = read_json(config_file)
+    with _config_cache_lock:
+        _config_cache[key] = (stamp, config)
+    return dict(config), stamp
+
+def read_agent_config(username, agent_name):
+    """
+    Return an agent's config.json, reusing the cached parse while the file is unchanged.
+    Raises FileNotFoundError if the agent has no config.
+    """
+    return _read_agent_config_stamped(username, agent_name)[0]
+
+def _store_agent_config(username, agent_name, config):
+    """Write config.json and seed the cache with it; caller holds locked(config_file)"""
+    config_file = _agent_paths(username, agent_name).config_file
+    write_json(config_file, config)
+    stamp = _stat_stamp(config_file)
+    with _config_cache_lock:
+        _config_cache[(username, agent_name)] = (stamp, config)
+
+def write_agent_config(username, agent_name, config):
+    """Write an agent's config.json, keeping the cache current"""
+    with locked(_agent_paths(username, agent_name).config_file):
+        _store_agent_config(username, agent_name, dict(config))
+
+def update_agent_config(username, agent_name, mutate):
+    """
+    Apply `mutate` to an agent's config.json under its file lock and write it back,
+    keeping the cache current. Returns a copy of the updated config.
+    """
+    with locked(_agent_paths(username, agent_name).config_file):
+        config, _ = _read_agent_config_stamped(username, agent_name)
+        mutate(config)
+        _store_agent_config(username, agent_name, config)
+    return dict(config)
+
+# Agent directory names per user: username -> (AGENTS dir mtime_ns, [names]). Creating,
+# renaming or deleting an agent changes the directory's mtime; config edits don't, and are
+# picked up through the config cache.
+_agent_names_cache = {}
+_agent_names_cache_lock = threading.Lock()
+
+def _list_agent_names(username):
+    """
+    Names of a user's agents, re-reading the AGENTS directory only when it changed.
+    Raises FileNotFoundError if the user has no AGENTS directory yet.
+    """
+    agents_dir = _user_agents_dir(username)
+    mtime = os.stat(agents_dir).st_mtime_ns
+    with _agent_names_cache_lock:
+        cached = _agent_names_cache.get(username)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    # One directory enumeration; DirEntry.is_dir() answers from the readdir data
+    # (follow_symlinks=False so symlinked entries don't cost an extra stat)
+    with os.scandir(agents_dir) as it:
+        agent_names = [entry.name for entry in it if entry.is_dir(follow_symlinks=False)]
+    with _agent_names_cache_lock:
+        _agent_names_cache[username] = (mtime, agent_names)
+    return agent_names
+
+def _invalidate_agent_names(username):
+    """Drop the cached listing; covers filesystems whose mtime is too coarse to notice"""
+    with _agent_names_cache_lock:
+        _agent_names_cache.pop(username, None)
+
+def _agent_state_etag(username, agent_name):
+    """ETag covering an agent's config.json and files.jsonl"""
+    paths = _agent_paths(username, agent_name)
+    stamps = [username, agent_name]
+    for path in (paths.config_file, paths.files_log):
+        try:
+            stamps.append(_stat_stamp(path))
+        except FileNotFoundError:
+            stamps.append(None)
+    return _make_etag(stamps)
 
 ########################
 # Authentication & Pages
 ########################
 
 @app.route('/')
+@login_required()
 def index():
-    if 'username' not in session:
-        return redirect(url_for('login'))
     return redirect(url_for('dashboard'))
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -151,17 +519,18 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
 
-        user = next((u for u in VALID_USERS if u['username'] == username and u['password'] == password), None)
+        stored_password = VALID_USERS_BY_NAME.get(username)
 
-        if user:
+        # Constant-time comparison so response timing doesn't leak the password
+        if stored_password is not None and hmac.compare_digest(
+            stored_password.encode('utf-8'), (password or '').encode('utf-8')
+        ):
             session['username'] = username
             user_dir = os.path.join(DATA_DIR, username)
-            agents_dir = os.path.join(user_dir, 'AGENTS')
+            agents_dir = _user_agents_dir(username)
 
-            if not os.path.exists(user_dir):
-                os.makedirs(user_dir)
-            if not os.path.exists(agents_dir):
-                os.makedirs(agents_dir)
+            os.makedirs(user_dir, exist_ok=True)
+            os.makedirs(agents_dir, exist_ok=True)
 
             return redirect(url_for('dashboard'))
         else:
@@ -175,28 +544,24 @@ def logout():
     return redirect(url_for('login'))
 
 @app.route('/dashboard')
+@login_required()
 def dashboard():
-    if 'username' not in session:
-        return redirect(url_for('login'))
     return render_template('dashboard.html')
 
 @app.route('/my-agents')
+@login_required()
 def my_agents():
-    if 'username' not in session:
-        return redirect(url_for('login'))
     return render_template('my-agents.html')
 
 @app.route('/config')
+@login_required()
 def config():
-    if 'username' not in session:
-        return redirect(url_for('login'))
     agent_name = request.args.get('agent', '')
     return render_template('config.html', agent_name=agent_name)
 
 @app.route('/manage/<agent_name>')
+@login_required()
 def manage(agent_name):
-    if 'username' not in session:
-        return redirect(url_for('login'))
     return render_template('manage.html', agent_name=agent_name)
 
 ########################
@@ -204,452 +569,517 @@ def manage(agent_name):
 ########################
 
 @app.route('/api/agents', methods=['GET'])
+@login_required(api=True)
 def get_agents():
-    if 'username' not in session:
-        return jsonify({"error": "Not authenticated"}), 401
-
-    username = session['username']
-    agents_dir = os.path.join(DATA_DIR, username, 'AGENTS')
-    if not os.path.exists(agents_dir):
-        return jsonify({"agents": []})
+    username = g.username
+    try:
+        agent_names = _list_agent_names(username)
+    except FileNotFoundError:
+        return _json({"agents": []})
 
     agents = []
-    for agent_name in os.listdir(agents_dir):
-        agent_dir = os.path.join(agents_dir, agent_name)
-        config_file = os.path.join(agent_dir, 'config.json')
-
-        if os.path.isdir(agent_dir) and os.path.exists(config_file):
-            with open(config_file, 'r') as f:
-                config = json.load(f)
-                agents.append(config)
+    stamps = [username]
+    for agent_name in agent_names:
+        try:
+            config, stamp = _read_agent_config_stamped(username, agent_name)
+        except FileNotFoundError:
+            continue
+        agents.append(config)
+        stamps.append((agent_name, stamp))
 
-    return jsonify({"agents": agents})
+    return _json_conditional({"agents": agents}, _make_etag(stamps))
 
 @app.route('/api/agents/<agent_name>', methods=['GET'])
+@login_required(api=True)
 def get_agent(agent_name):
-    if 'username' not in session:
-        return jsonify({"error": "Not authenticated"}), 401
-
-    username = session['username']
-    agent_dir = os.path.join(DATA_DIR, username, 'AGENTS', agent_name)
-    config_file = os.path.join(agent_dir, 'config.json')
-
-    if not os.path.exists(config_file):
-        return jsonify({"error": "Agent not found"}), 404
-
-    with open(config_file, 'r') as f:
-        config = json.load(f)
+    username = g.username
+    paths = _agent_paths(username, agent_name)
+    # Taken before reading so a concurrent write can only make the tag stale, never the payload
+    etag = _agent_state_etag(username, agent_name)
+    try:
+        config = read_agent_config(username, agent_name)
+    except FileNotFoundError:
+        return _json({"error": "Agent not found"}, 404)
 
-    # Ensure files.json is up to date
+    # Ensure files.jsonl is up to date
     files_data = get_files_json(username, agent_name)
-    # If no files in files.json, attempt to detect existing uploads
+    # If no files in files.jsonl, attempt to detect existing uploads
     if not files_data['files']:
-        uploads_dir = os.path.join(agent_dir, 'uploads')
-        if os.path.exists(uploads_dir):
-            for file_name in os.listdir(uploads_dir):
-                file_path = os.path.join(uploads_dir, file_name)
-                if os.path.isfile(file_path):
-                    processed_file = os.path.join(agent_dir, 'processed', f"{Path(file_name).stem}.json")
-                    processed = os.path.exists(processed_file)
-                    file_info = {
-                        "name": file_name,
-                        "size": os.path.getsize(file_path),
-                        "type": "application/pdf" if file_name.lower().endswith('.pdf') else "",
-                        "lastModified": os.path.getmtime(file_path),
-                        "processed": processed,
-                        "processing_status": "success" if processed else "pending",
-                        "error_message": None
+        try:
+            with os.scandir(paths.uploads_dir) as it:
+                upload_entries = [entry for entry in it if entry.is_file()]
+        except FileNotFoundError:
+            upload_entries = []
+        if upload_entries:
+            # One directory read instead of an exists() per upload
+            try:
+                with os.scandir(paths.processed_dir) as it:
+                    processed_stems = {
+                        entry.name[:-5] for entry in it
+                        if entry.name.endswith('.json') and entry.is_file()
                     }
-                    add_file_to_json(username, agent_name, file_info)
-        files_data = get_files_json(username, agent_name)
+            except FileNotFoundError:
+                processed_stems = set()
+            detected_files = []
+            for entry in upload_entries:
+                st = entry.stat()
+                processed = Path(entry.name).stem in processed_stems
+                file_info = {
+                    "name": entry.name,
+                    "size": st.st_size,
+                    "type": "application/pdf" if _is_pdf(entry.name) else "",
+                    "lastModified": st.st_mtime,
+                    "processed": processed,
+                    "processing_status": "success" if processed else "pending",
+                    "error_message": None
+                }
+                detected_files.append(file_info)
+            add_files_to_json(username, agent_name, detected_files)
+            files_data = get_files_json(username, agent_name)
 
     config['files'] = files_data['files']
-    return jsonify(config)
+    return _json_conditional(config, etag)
 
 @app.route('/api/agents', methods=['POST'])
+@login_required(api=True)
 def create_agent():
-    if 'username' not in session:
-        return jsonify({"error": "Not authenticated"}), 401
-
     try:
         data = request.json
         if not data:
-            return jsonify({"error": "Invalid JSON data"}), 400
+            return _json({"error": "Invalid JSON data"}, 400)
             
-        username = session['username']
+        username = g.username
         agent_name = data.get('name')
         agent_persona = data.get('persona', '')
 
         if not agent_name:
-            return jsonify({"error": "Agent name is required"}), 400
+            return _json({"error": "Agent name is required"}, 400)
 
         # Validate agent name
-        if not re.match(r'^[a-zA-Z0-9_\- ]+$', agent_name):
-            return jsonify({"error": "Agent name contains invalid characters. Use only letters, numbers, spaces, hyphens, and underscores."}), 400
+        if not _AGENT_NAME_RE.match(agent_name):
+            return _json({"error": "Agent name contains invalid characters. Use only letters, numbers, spaces, hyphens, and underscores."}, 400)
 
-        agent_dir = os.path.join(DATA_DIR, username, 'AGENTS', agent_name)
-        uploads_dir = os.path.join(agent_dir, 'uploads')
-        processed_dir = os.path.join(agent_dir, 'processed')
+        paths = _agent_paths(username, agent_name)
+        agent_dir = paths.agent_dir
 
         if os.path.exists(agent_dir):
-            return jsonify({"error": "Agent with this name already exists"}), 400
+            return _json({"error": "Agent with this name already exists"}, 400)
 
         try:
-            os.makedirs(agent_dir, exist_ok=True)
-            os.makedirs(uploads_dir, exist_ok=True)
-            os.makedirs(processed_dir, exist_ok=True)
+            # makedirs creates agent_dir along with its first child
+            for subdir in (paths.uploads_dir, paths.processed_dir):
+                os.makedirs(subdir, exist_ok=True)
         except OSError as e:
             logging.error(f"Error creating directories for agent {agent_name}: {str(e)}")
-            return jsonify({"error": f"Failed to create agent directories: {str(e)}"}), 500
+            return _json({"error": f"Failed to create agent directories: {str(e)}"}, 500)
+        _invalidate_agent_names(username)
 
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
         config = {
             "name": agent_name,
             "persona": agent_persona,
-            "createdAt": datetime.datetime.now().isoformat(),
-            "updatedAt": datetime.datetime.now().isoformat(),
+            "createdAt": now,
+            "updatedAt": now,
             "createdBy": username,
             "files_processed": False,
             "processing_complete": False
         }
 
         try:
-            with open(os.path.join(agent_dir, 'config.json'), 'w') as f:
-                json.dump(config, f, indent=2)
+            write_agent_config(username, agent_name, config)
         except IOError as e:
             logging.error(f"Error creating config file for agent {agent_name}: {str(e)}")
             shutil.rmtree(agent_dir, ignore_errors=True)
-            return jsonify({"error": f"Failed to create agent configuration: {str(e)}"}), 500
+            return _json({"error": f"Failed to create agent configuration: {str(e)}"}, 500)
 
-        # Create empty files.json
+        # Create empty files.jsonl
         try:
             create_files_json(username, agent_name)
         except Exception as e:
-            logging.error(f"Error creating files.json for agent {agent_name}: {str(e)}")
+            logging.error(f"Error creating files.jsonl for agent {agent_name}: {str(e)}")
             shutil.rmtree(agent_dir, ignore_errors=True)
-            return jsonify({"error": f"Failed to initialize agent files: {str(e)}"}), 500
+            return _json({"error": f"Failed to initialize agent files: {str(e)}"}, 500)
 
-        return jsonify({"message": "Agent created successfully", "agent": config})
+        return _json({"message": "Agent created successfully", "agent": config})
     
     except Exception as e:
         logging.error(f"Unexpected error creating agent: {str(e)}")
-        return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
+        return _json({"error": f"An unexpected error occurred: {str(e)}"}, 500)
 
 @app.route('/api/agents/<agent_name>', methods=['PUT'])
+@login_required(api=True)
 def update_agent(agent_name):
-    if 'username' not in session:
-        return jsonify({"error": "Not authenticated"}), 401
-
     data = request.json
-    username = session['username']
+    username = g.username
 
-    agent_dir = os.path.join(DATA_DIR, username, 'AGENTS', agent_name)
-    config_file = os.path.join(agent_dir, 'config.json')
+    paths = _agent_paths(username, agent_name)
+    config_file = paths.config_file
 
     if not os.path.exists(config_file):
-        return jsonify({"error": "Agent not found"}), 404
-
-    with open(config_file, 'r') as f:
-        config = json.load(f)
+        return _json({"error": "Agent not found"}, 404)
 
     # If "name" changed, rename the folder
     if 'name' in data and data['name'] != agent_name:
-        new_agent_dir = os.path.join(DATA_DIR, username, 'AGENTS', data['name'])
-        os.rename(agent_dir, new_agent_dir)
-        agent_dir = new_agent_dir
-        config_file = os.path.join(agent_dir, 'config.json')
-
-    config['name'] = data.get('name', config['name'])
-    config['persona'] = data.get('persona', config['persona'])
-    config['updatedAt'] = datetime.datetime.now().isoformat()
-
-    with open(config_file, 'w') as f:
-        json.dump(config, f, indent=2)
-
-    return jsonify({"message": "Agent updated successfully", "agent": config})
+        if not _AGENT_NAME_RE.match(data['name']):
+            return _json({"error": "Agent name contains invalid characters. Use only letters, numbers, spaces, hyphens, and underscores."}, 400)
+        new_paths = _agent_paths(username, data['name'])
+        # os.replace would silently clobber an empty directory, so refuse existing targets up front
+        if os.path.exists(new_paths.agent_dir):
+            return _json({"error": "Agent with this name already exists"}, 400)
+        os.replace(paths.agent_dir, new_paths.agent_dir)
+        _invalidate_files_json(username, agent_name)
+        _invalidate_agent_names(username)
+        agent_name = data['name']
+
+    def apply_update(config):
+        config['name'] = data.get('name', config['name'])
+        config['persona'] = data.get('persona', config['persona'])
+        config['updatedAt'] = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+
+    config = update_agent_config(username, agent_name, apply_update)
+
+    return _json({"message": "Agent updated successfully", "agent": config})
 
 @app.route('/api/agents/<agent_name>', methods=['DELETE'])
+@login_required(api=True)
 def delete_agent(agent_name):
-    if 'username' not in session:
-        return jsonify({"error": "Not authenticated"}), 401
-
-    username = session['username']
-    agent_dir = os.path.join(DATA_DIR, username, 'AGENTS', agent_name)
-
-    if not os.path.exists(agent_dir):
-        return jsonify({"error": "Agent not found"}), 404
-
-    shutil.rmtree(agent_dir)
-    return jsonify({"message": "Agent deleted successfully"})
+    username = g.username
+    try:
+        shutil.rmtree(_agent_paths(username, agent_name).agent_dir)
+    except FileNotFoundError:
+        return _json({"error": "Agent not found"}, 404)
+    except OSError as e:
+        logging.error(f"Error deleting agent {agent_name}: {str(e)}")
+        return _json({"error": f"Failed to delete agent: {str(e)}"}, 500)
+    _invalidate_files_json(username, agent_name)
+    _invalidate_agent_names(username)
+    return _json({"message": "Agent deleted successfully"})
 
 ########################
 # Upload / Processing
 ########################
 
 @app.route('/api/agents/<agent_name>/upload', methods=['POST'])
+@login_required(api=True)
 def upload_files(agent_name):
-    if 'username' not in session:
-        return jsonify({"error": "Not authenticated"}), 401
-
-    username = session['username']
-    agent_dir = os.path.join(DATA_DIR, username, 'AGENTS', agent_name)
-    uploads_dir = os.path.join(agent_dir, 'uploads')
-    config_file = os.path.join(agent_dir, 'config.json')
+    username = g.username
+    paths = _agent_paths(username, agent_name)
+    agent_dir = paths.agent_dir
+    uploads_dir = paths.uploads_dir
+    config_file = paths.config_file
 
     if not os.path.exists(agent_dir):
-        return jsonify({"error": "Agent not found"}), 404
-
-    if not os.path.exists(uploads_dir):
-        os.makedirs(uploads_dir)
-
-    ALLOWED_EXTENSIONS = {'pdf'}
+        return _json({"error": "Agent not found"}, 404)
 
-    def allowed_file(filename):
-        return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    os.makedirs(uploads_dir, exist_ok=True)
 
-    uploaded_files = []
+    # Keyed by name: a name repeated within one request is written once (last copy
+    # wins) and queued for processing once
+    uploaded_files = {}
     rejected_files = []
 
     for file in request.files.getlist('files'):
-        filename = secure_filename(file.filename)
-        if not allowed_file(filename):
+        filename = _secure_filename(file.filename)
+        if not _allowed_file(filename):
             rejected_files.append(filename)
             continue
 
         file_path = os.path.join(uploads_dir, filename)
-        file.save(file_path)
+        # Copy in 1 MiB chunks rather than Werkzeug's 16 KiB default
+        with open(file_path, 'wb') as dst:
+            shutil.copyfileobj(file.stream, dst, length=UPLOAD_COPY_BUFSIZE)
+            dst.flush()
+            # Size/mtime from the open descriptor: no second path lookup
+            st = os.fstat(dst.fileno())
+        # Release Werkzeug's spooled temp file now rather than at the end of the request
+        file.close()
 
         file_info = {
             "name": filename,
-            "size": os.path.getsize(file_path),
+            "size": st.st_size,
             "type": file.content_type,
-            "lastModified": os.path.getmtime(file_path),
+            "lastModified": st.st_mtime,
             "processed": False,
             "processing_status": "pending",
             "error_message": None
         }
-        add_file_to_json(username, agent_name, file_info)
-        uploaded_files.append(file_info)
+        uploaded_files[filename] = file_info
 
     # If new files were uploaded, reset config states and process in background
     if uploaded_files:
-        with open(config_file, 'r') as f:
-            config = json.load(f)
-        config['files_processed'] = False
-        config['processing_complete'] = False
+        add_files_to_json(username, agent_name, list(uploaded_files.values()))
 
-        with open(config_file, 'w') as f:
-            json.dump(config, f, indent=2)
+        def reset_processing(config):
+            config['files_processed'] = False
+            config['processing_complete'] = False
+
+        update_agent_config(username, agent_name, reset_processing)
 
         api_key = os.environ.get('GEMINI_API_KEY')
         if not api_key:
             logging.warning("GEMINI_API_KEY not found. Advanced processing may be limited.")
 
-        file_names = [file['name'] for file in uploaded_files]
-        processing_thread = threading.Thread(
-            target=process_agent_files,
-            args=(username, agent_name, agent_dir, file_names, config_file, api_key)
-        )
-        processing_thread.daemon = True
-        processing_thread.start()
+        file_names = list(uploaded_files)
+        process_agent_files(username, agent_name, agent_dir, file_names, config_file, api_key)
 
     response = {
         "message": "Files uploaded successfully",
-        "files": uploaded_files
+        "files": list(uploaded_files.values())
     }
     if rejected_files:
         response["rejected_files"] = rejected_files
         response["rejection_reason"] = "Only PDF files are supported"
 
-    return jsonify(response)
-
-@app.route('/api/agents/<agent_name>/processing-status', methods=['GET'])
-def get_processing_status(agent_name):
-    if 'username' not in session:
-        return jsonify({"error": "Not authenticated"}), 401
-
-    username = session['username']
-    agent_dir = os.path.join(DATA_DIR, username, 'AGENTS', agent_name)
-    config_file = os.path.join(agent_dir, 'config.json')
+    return _json(response)
 
-    if not os.path.exists(config_file):
-        return jsonify({"error": "Agent not found"}), 404
-
-    with open(config_file, 'r') as f:
-        config = json.load(f)
-
-    files_data = get_files_json(username, agent_name)
-    file_status = {}
-    for file in files_data['files']:
-        file_status[file['name']] = {
-            'status': file['processing_status'],
+def _processing_status_payload(username, agent_name, config):
+    file_status = {
+        name: {
+            'status': file.get('processing_status', 'pending'),
             'message': file.get('error_message') or ''
         }
-
-    return jsonify({
+        for name, file in get_files_index(username, agent_name).items()
+    }
+    return {
         "agent_name": agent_name,
         "processing_complete": config.get('processing_complete', False),
         "files_processed": config.get('files_processed', False),
         "file_status": file_status
-    })
+    }
+
+@app.route('/api/agents/<agent_name>/processing-status', methods=['GET'])
+@login_required(api=True)
+def get_processing_status(agent_name):
+    username = g.username
+    etag = _agent_state_etag(username, agent_name)
+    try:
+        config = read_agent_config(username, agent_name)
+    except FileNotFoundError:
+        return _json({"error": "Agent not found"}, 404)
+
+    return _json_conditional(_processing_status_payload(username, agent_name, config), etag)
+
+@app.route('/api/agents/<agent_name>/processing-status/stream', methods=['GET'])
+@login_required(api=True)
+def stream_processing_status(agent_name):
+    """
+    Server-Sent Events version of /processing-status: pushes a status snapshot
+    whenever it changes. In-process writers wake the stream immediately; the
+    periodic recheck catches writes from other worker processes. The stream
+    ends after STATUS_STREAM_MAX_SECONDS, or once nothing is left to process,
+    and EventSource reconnects on its own.
+    """
+    username = g.username
+    if not os.path.exists(_agent_paths(username, agent_name).config_file):
+        return _json({"error": "Agent not found"}, 404)
+
+    def generate():
+        yield f"retry: {STATUS_STREAM_RETRY_MS}\n\n".encode()
+        last_etag = None
+        deadline = time.monotonic() + STATUS_STREAM_MAX_SECONDS
+        while time.monotonic() < deadline:
+            version = get_status_version(username, agent_name)
+            etag = _agent_state_etag(username, agent_name)
+            if etag != last_etag:
+                try:
+                    config = read_agent_config(username, agent_name)
+                except FileNotFoundError:
+                    return
+                payload = _processing_status_payload(username, agent_name, config)
+                yield b"data: " + dumps(payload) + b"\n\n"
+                last_etag = etag
+                if not any(status['status'] in ('pending', 'processing')
+                           for status in payload['file_status'].values()):
+                    # Idle: free the thread rather than holding it for keep-alives
+                    return
+            else:
+                # Comment line keeps proxies from timing out an idle stream
+                yield b": keep-alive\n\n"
+            wait_for_status_change(username, agent_name, version, STATUS_STREAM_RECHECK_SECONDS)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/api/agents/<agent_name>/files/<filename>', methods=['DELETE'])
+@login_required(api=True)
 def delete_file(agent_name, filename):
-    if 'username' not in session:
-        return jsonify({"error": "Not authenticated"}), 401
-
-    username = session['username']
-    file_path = os.path.join(DATA_DIR, username, 'AGENTS', agent_name, 'uploads', secure_filename(filename))
-    if not os.path.exists(file_path):
-        return jsonify({"error": "File not found"}), 404
-
-    os.remove(file_path)
-    processed_path = os.path.join(
-        DATA_DIR, username, 'AGENTS', agent_name, 'processed',
-        f"{Path(filename).stem}.json"
-    )
-    if os.path.exists(processed_path):
+    username = g.username
+    safe_name = _secure_filename(filename)
+    paths = _agent_paths(username, agent_name)
+    try:
+        os.remove(os.path.join(paths.uploads_dir, safe_name))
+    except FileNotFoundError:
+        return _json({"error": "File not found"}, 404)
+
+    processed_path = os.path.join(paths.processed_dir, f"{Path(safe_name).stem}.json")
+    try:
         os.remove(processed_path)
+    except FileNotFoundError:
+        pass
 
-    remove_file_from_json(username, agent_name, filename)
-    return jsonify({"message": "File deleted successfully"})
+    remove_file_from_json(username, agent_name, safe_name)
+    return _json({"message": "File deleted successfully"})
 
 @app.route('/api/agents/<agent_name>/files/<filename>')
+@login_required(api=True)
 def get_file(agent_name, filename):
-    if 'username' not in session:
-        return jsonify({"error": "Not authenticated"}), 401
-    username = session['username']
-    uploads_dir = os.path.join(DATA_DIR, username, 'AGENTS', agent_name, 'uploads')
-    return send_from_directory(uploads_dir, secure_filename(filename))
+    username = g.username
+    safe_name = _secure_filename(filename)
+    if SENDFILE_MODE == 'nginx':
+        # nginx serves the file itself (with its own ETag/Range handling) from its internal location
+        accel_path = '/'.join(quote(part) for part in (username, 'AGENTS', agent_name, 'uploads', safe_name))
+        response = Response(headers={'X-Accel-Redirect': f"{ACCEL_REDIRECT_PREFIX}/{accel_path}"})
+    else:
+        uploads_dir = _agent_paths(username, agent_name).uploads_dir
+        # ETag/Last-Modified let the browser revalidate with a 304 instead of re-downloading
+        # (max_age keeps Werkzeug from defaulting to no-cache; Expires then matches too)
+        response = send_from_directory(uploads_dir, safe_name, conditional=True, etag=True,
+                                       max_age=UPLOAD_CACHE_MAX_AGE)
+    # nginx passes Cache-Control through on X-Accel-Redirect. Replacing the header outright
+    # (rather than adding directives to whatever Werkzeug set) gives every mode one policy
+    response.headers['Cache-Control'] = UPLOAD_CACHE_CONTROL
+    return response
 
 @app.route('/api/current-user', methods=['GET'])
+@login_required(api=True)
 def get_current_user():
-    if 'username' not in session:
-        return jsonify({"error": "Not authenticated"}), 401
-    return jsonify({"username": session['username']})
+    return _json({"username": g.username})
 
 ########################
 # Chat Routes
 ########################
 
 @app.route('/chat/<agent_name>')
+@login_required()
 def chat(agent_name):
-    if 'username' not in session:
-        return redirect(url_for('login'))
     return render_template('chat.html', agent_name=agent_name)
 
+def _ensure_chat_log(username, agent_name):
+    """Make sure chat_history.jsonl exists, converting a pre-JSON-Lines chat_history.json if there is one"""
+    paths = _agent_paths(username, agent_name)
+    legacy_path = os.path.join(paths.agent_dir, 'chat_history.json')
+    os.makedirs(paths.agent_dir, exist_ok=True)
+    with locked(paths.chat_log):
+        if os.path.exists(paths.chat_log):
+            return
+        try:
+            conversations = read_json(legacy_path).get("conversations") or []
+        except FileNotFoundError:
+            conversations = None
+        except json.JSONDecodeError:
+            conversations = []
+        if isinstance(conversations, dict):
+            conversations = list(conversations.values())
+        write_json_lines(paths.chat_log, [{"conversation": c} for c in conversations or []])
+        if conversations is not None:
+            os.remove(legacy_path)
+
+def _fold_chat_records(records):
+    """
+    Fold chat_history.jsonl into {conversation_id: conversation}. A line is either a
+    {"conversation": {...}} snapshot, or a {"conversation_id": ..., "message"/"analysis": ...}
+    event appended to that conversation.
+    """
+    conversations = {}
+    for record in records:
+        if 'conversation' in record:
+            conversation = record['conversation']
+            conversations[conversation['conversation_id']] = conversation
+            continue
+        conversation_id = record['conversation_id']
+        conversation = conversations.get(conversation_id)
+        if conversation is None:
+            conversation = conversations[conversation_id] = {
+                "conversation_id": conversation_id,
+                "messages": []
+            }
+        if 'message' in record:
+            conversation['messages'].append(record['message'])
+        if 'analysis' in record:
+            conversation.setdefault('analysis', []).append(record['analysis'])
+    return conversations
+
+def _append_chat_records(username, agent_name, records):
+    """Append events to an agent's chat log; O(record) no matter how long the history is"""
+    chat_log = _agent_paths(username, agent_name).chat_log
+    if not os.path.exists(chat_log):
+        _ensure_chat_log(username, agent_name)
+    # Shares the lock with clear-chat so an append can't land in a log being replaced
+    with locked(chat_log):
+        append_json_lines(chat_log, records)
+
 @app.route('/api/agents/<agent_name>/chat-history', methods=['GET'])
+@login_required(api=True)
 def get_chat_history(agent_name):
     """
     Returns the JSON object containing 'conversations': [...],
     each with a conversation_id and a messages array, plus optional 'analysis' array if present.
     """
-    if 'username' not in session:
-        return jsonify({"error": "Not authenticated"}), 401
-
-    username = session['username']
-    chat_file = os.path.join(DATA_DIR, username, 'AGENTS', agent_name, 'chat_history.json')
+    username = g.username
+    chat_log = _agent_paths(username, agent_name).chat_log
+    if not os.path.exists(chat_log):
+        _ensure_chat_log(username, agent_name)
 
-    if not os.path.exists(chat_file):
-        default_history = {"conversations": []}
-        os.makedirs(os.path.dirname(chat_file), exist_ok=True)
-        with open(chat_file, 'w') as f:
-            json.dump(default_history, f, indent=2)
-        return jsonify(default_history)
-
-    try:
-        with open(chat_file, 'r') as f:
-            return jsonify(json.load(f))
-    except json.JSONDecodeError:
-        default_history = {"conversations": []}
-        with open(chat_file, 'w') as f:
-            json.dump(default_history, f, indent=2)
-        return jsonify(default_history)
+    conversations = _fold_chat_records(read_json_lines(chat_log))
+    return _json({"conversations": list(conversations.values())})
 
 @app.route('/api/agents/<agent_name>/clear-chat', methods=['POST'])
+@login_required(api=True)
 def clear_chat_history(agent_name):
     """
-    Overwrites the agent's chat_history.json with an empty 'conversations' list.
+    Empties the agent's chat_history.jsonl.
     """
-    if 'username' not in session:
-        return jsonify({"error": "Not authenticated"}), 401
-
-    username = session['username']
-    chat_file = os.path.join(DATA_DIR, username, 'AGENTS', agent_name, 'chat_history.json')
+    username = g.username
+    chat_log = _agent_paths(username, agent_name).chat_log
 
     try:
-        default_history = {"conversations": []}
-        os.makedirs(os.path.dirname(chat_file), exist_ok=True)
-        with open(chat_file, 'w') as f:
-            json.dump(default_history, f, indent=2)
-        return jsonify({"message": "Chat history cleared"})
+        _ensure_chat_log(username, agent_name)
+        with locked(chat_log):
+            write_json_lines(chat_log, [])
+        return _json({"message": "Chat history cleared"})
     except Exception as e:
         logging.error(f"Error clearing chat history: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        return _json({"error": str(e)}, 500)
 
 ########################
 # NEW: Send Message Flow
 ########################
 
 @app.route('/api/agents/<agent_name>/send-message', methods=['POST'])
+@login_required(api=True)
 def send_message(agent_name):
     """
     Handles the user message:
       1) Append user message to chat_history
       2) Analyze prompt (splitting, keywords) => store analysis in chat_history
-      3) Perform retrieval => store in retrieval_results.json
+      3) Perform retrieval => store in retrieval_results.jsonl
       4) Build final answer with sources from retrieval_results
       5) Append answer to chat_history
       6) Return answer + sources
     """
-    if 'username' not in session:
-        return jsonify({"error": "Not authenticated"}), 401
-
     data = request.get_json()
     user_message = data.get('message', '').strip()
     conversation_id = data.get('conversation_id') or "default"
-    username = session['username']
-
-    # 1) Load or create local chat file for this agent
-    agent_dir = os.path.join(DATA_DIR, username, 'AGENTS', agent_name)
-    chat_file = os.path.join(agent_dir, 'chat_history.json')
-    if not os.path.exists(chat_file):
-        os.makedirs(os.path.dirname(chat_file), exist_ok=True)
-        with open(chat_file, 'w') as f:
-            json.dump({"conversations": []}, f, indent=2)
-
-    with open(chat_file, 'r') as f:
-        chat_history = json.load(f)
-
-    conversations = chat_history.get("conversations", [])
-    conversation = next((c for c in conversations if c["conversation_id"] == conversation_id), None)
-    if not conversation:
-        conversation = {
-            "conversation_id": conversation_id,
-            "messages": []
-        }
-        conversations.append(conversation)
+    username = g.username
 
-    # 2) Append user message to conversation
+    # 1) User message, timestamped on arrival
     user_msg_obj = {
         "role": "user",
         "content": user_message,
-        "timestamp": datetime.datetime.now().isoformat()
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat()
     }
-    conversation["messages"].append(user_msg_obj)
 
-    # 3) Analyze prompt (Gemini or fallback)
+    # 2) Analyze prompt (Gemini or fallback)
     api_key = os.environ.get('GEMINI_API_KEY')
-    analysis_result = analyze_prompt_with_gemini(api_key or "", user_message)
-
-    # Store analysis in conversation["analysis"]
-    if "analysis" not in conversation:
-        conversation["analysis"] = []
-    conversation["analysis"].append(analysis_result)
+    analysis_result = analyze_prompt_with_gemini(api_key or "", user_message, cache_scope=username)
 
-    # Save chat_history so far
-    chat_history["conversations"] = conversations
-    with open(chat_file, 'w') as f:
-        json.dump(chat_history, f, indent=2)
+    # 3) Append user message and analysis to the conversation
+    _append_chat_records(username, agent_name, [
+        {"conversation_id": conversation_id, "message": user_msg_obj},
+        {"conversation_id": conversation_id, "analysis": analysis_result}
+    ])
 
     # 4) Perform retrieval with sub-queries and original query
     perform_retrieval_for_analysis(
@@ -675,16 +1105,13 @@ def send_message(agent_name):
         "role": "assistant",
         "content": response["answer"],
         "sources": response["sources"],  # New format: array of {file, page} objects
-        "timestamp": datetime.datetime.now().isoformat()
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat()
     }
-    conversation["messages"].append(assistant_msg_obj)
+    _append_chat_records(username, agent_name, [
+        {"conversation_id": conversation_id, "message": assistant_msg_obj}
+    ])
 
-    # Save entire chat again
-    chat_history["conversations"] = conversations
-    with open(chat_file, 'w') as f:
-        json.dump(chat_history, f, indent=2)
-
-    return jsonify({
+    return _json({
         "conversation_id": conversation_id,
         "message": assistant_msg_obj
     })
@@ -695,21 +1122,19 @@ def send_message(agent_name):
 
 def build_final_answer_with_citations(api_key, analysis, username, agent_name, conversation_id):
     """
-    1) Load retrieval chunks from retrieval_results.json for all sub-queries and original_query
+    1) Load retrieval chunks from retrieval_results.jsonl for all sub-queries and original_query
     2) Merge them, deduplicate
     3) Pass them to LLM as context
     4) Return the answer and sources
     """
     # -- Load retrieval results
-    agent_dir = os.path.join(DATA_DIR, username, 'AGENTS', agent_name)
-    retrieval_file = os.path.join(agent_dir, 'retrieval_results.json')
-    if not os.path.exists(retrieval_file):
+    retrieval_file = _agent_paths(username, agent_name).retrieval_file
+    try:
+        retrieval_data = load_retrieval_results(retrieval_file)
+    except FileNotFoundError:
         # No retrieval
         return {"answer": "I have no relevant documents to reference.", "sources": []}
 
-    with open(retrieval_file, 'r', encoding='utf-8') as f:
-        retrieval_data = json.load(f)
-
     conv_dict = retrieval_data.get(conversation_id, {})
     if not conv_dict:
         # No retrieval results for this conversation
@@ -760,6 +1185,16 @@ def build_final_answer_with_citations(api_key, analysis, username, agent_name, c
     return response
 
 
+# Salvaging JSON from a non-JSON LLM reply (compiled once, not per reply)
+_JSON_OBJECT_RE = re.compile(r'{[\s\S]*}')
+_CODE_FENCE_RE = re.compile(r'```json\s*|\s*```')
+_ANSWER_FIELD_RE = re.compile(r'"answer"\s*:\s*"([^"]*)"')
+_SOURCES_FIELD_RE = re.compile(r'"sources"\s*:\s*\[(.*?)\]', re.DOTALL)
+_SOURCE_ENTRY_RE = re.compile(r'{\s*"file"\s*:\s*"([^"]*)"\s*,\s*"page"\s*:\s*(\d+)\s*}')
+# Citations in the retrieval context, for the no-Gemini fallback answer
+_CONTEXT_REFERENCE_RE = re.compile(r'Reference \[(\d+)\]: File: ([^,]+), Page: (\d+)')
+
+
 def call_llm_with_structured_response(api_key, user_query, context_text):
     """
     We supply the context from retrieval, and ask the LLM to:
@@ -833,56 +1268,41 @@ Think carefully and make sure to check that you satisfy every guideline and the
             logging.info(f"Raw Gemini response: {response_text[:100]}...")  # Log first 100 chars for debugging
             
             try:
-                import json
                 # First attempt: direct JSON parsing
-                json_response = json.loads(response_text)
+                json_response = loads(response_text)
                 return json_response
             except json.JSONDecodeError:
                 # Second attempt: extract JSON with regex
-                import re
-                # Look for anything that looks like a JSON object (between curly braces)
-                json_pattern = r'({[\s\S]*})'
-                match = re.search(json_pattern, response_text)
+                # Look for anything that looks like a JSON object (first '{' to last '}', one scan)
+                match = _JSON_OBJECT_RE.search(response_text)
                 if match:
                     try:
-                        json_response = json.loads(match.group(1))
+                        json_response = loads(match.group(0))
                         return json_response
                     except json.JSONDecodeError:
                         pass
                 
                 # Third attempt: more aggressive cleanup - strip markdown code blocks
-                cleaned_text = re.sub(r'```json\s*|\s*```', '', response_text)
+                cleaned_text = _CODE_FENCE_RE.sub('', response_text)
                 try:
-                    json_response = json.loads(cleaned_text)
+                    json_response = loads(cleaned_text)
                     return json_response
                 except json.JSONDecodeError:
                     pass
-                
-                # Fourth attempt: try to extract just the content between outermost braces
-                brace_pattern = r'({(?:[^{}]|(?R))*})'
-                match = re.search(brace_pattern, response_text)
-                if match:
-                    try:
-                        json_response = json.loads(match.group(1))
-                        return json_response
-                    except json.JSONDecodeError:
-                        pass
                         
                 # If all extraction attempts fail, construct a manual response
                 logging.error(f"Failed to parse Gemini response as JSON: {response_text}")
                 
                 # Create a manual response using patterns to extract content
-                answer_pattern = r'"answer"\s*:\s*"([^"]*)"'
-                answer_match = re.search(answer_pattern, response_text)
+                answer_match = _ANSWER_FIELD_RE.search(response_text)
                 answer = answer_match.group(1) if answer_match else "I couldn't parse the structured response correctly."
                 
                 # Extract sources if possible
                 sources = []
-                sources_pattern = r'"sources"\s*:\s*\[(.*?)\]'
-                sources_match = re.search(sources_pattern, response_text, re.DOTALL)
+                sources_match = _SOURCES_FIELD_RE.search(response_text)
                 if sources_match:
                     # Try to manually extract file and page entries
-                    source_entries = re.finditer(r'{\s*"file"\s*:\s*"([^"]*)"\s*,\s*"page"\s*:\s*(\d+)\s*}', sources_match.group(1))
+                    source_entries = _SOURCE_ENTRY_RE.finditer(sources_match.group(1))
                     for entry in source_entries:
                         sources.append({"file": entry.group(1), "page": int(entry.group(2))})
                 
@@ -911,8 +1331,7 @@ def fallback_structured_response(user_query, context_text):
     
     # Extract some basic source information from context
     sources = []
-    import re
-    references = re.findall(r'Reference \[(\d+)\]: File: ([^,]+), Page: (\d+)', context_text)
+    references = _CONTEXT_REFERENCE_RE.findall(context_text)
     seen = set()
     
     for _, file, page in references:
@@ -928,4 +1347,5 @@ def fallback_structured_response(user_query, context_text):
 
 
 if __name__ == '__main__':
+    # Development server only; in production run `gunicorn app:app` (see gunicorn.conf.py)
     app.run(debug=True)
\ No newline at end of file
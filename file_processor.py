@@ -6,19 +6,28 @@ Extracts content, tables, and advanced metadata using Gemini API.
 """
 
 import os
+import re
 import json
 import hashlib
+import functools
+import mmap
+import multiprocessing
 import logging
 import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple, Any, TypedDict
-from dataclasses import dataclass, asdict
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Set, Tuple, TypedDict
+from dataclasses import dataclass
 
 # External libraries for PDF processing
-import PyPDF2
 import pdfplumber
-import pandas as pd
+import numpy as np
+
+# Shared JSON (de)serialization (orjson when available)
+from json_utils import append_json_lines, atomic_writer, dumps, loads, locked, update_json
 
 # LLM integration for advanced metadata
 try:
@@ -29,6 +38,14 @@ except ImportError:
     HAS_GEMINI = False
     logging.warning("Gemini API not available. Advanced metadata extraction disabled.")
 
+# Optional: PyMuPDF's C text extractor for page text (pdfplumber still handles tables).
+# Not in requirements.txt because of its AGPL license; install it to opt in.
+try:
+    import fitz
+    HAS_PYMUPDF = True
+except ImportError:
+    HAS_PYMUPDF = False
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -77,6 +94,15 @@ class DocumentMetadata:
     total_tables: int
     pages_with_tables: int
 
+# Base directory for data storage (same location and override as app.DATA_DIR)
+DATA_DIR = os.getenv('ZAPIENT_DATA_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# Span from the first '{' to the last '}' of an LLM reply
+_JSON_OBJECT_RE = re.compile(r'{[\s\S]*}')
+
+# Maximum characters of document text sent to the LLM
+LLM_TEXT_LIMIT = 30000
+
 # System prompt for LLM
 SYSTEM_PROMPT = """You are a specialized oil/gas document analyst tasked with extracting structured metadata from technical documents. 
 
@@ -107,224 +133,311 @@ Return ONLY valid JSON matching this schema:
 # =============================================================================
 # FILE STATUS MANAGEMENT FUNCTIONS
 # =============================================================================
+# Per-agent change counters for processing status. Bumped on every status write so
+# streaming clients can block until something changes instead of polling.
+_status_versions: Dict[Tuple[str, str], int] = {}
+_status_changed = threading.Condition()
+
+def notify_status_change(username, agent_name):
+    """Signal anyone waiting on this agent's processing status."""
+    with _status_changed:
+        key = (username, agent_name)
+        _status_versions[key] = _status_versions.get(key, 0) + 1
+        _status_changed.notify_all()
+
+def get_status_version(username, agent_name) -> int:
+    """Current change counter for an agent's processing status."""
+    with _status_changed:
+        return _status_versions.get((username, agent_name), 0)
+
+def wait_for_status_change(username, agent_name, version: int, timeout: float) -> bool:
+    """Block until the agent's status moves past `version` or `timeout` expires."""
+    key = (username, agent_name)
+    with _status_changed:
+        return _status_changed.wait_for(lambda: _status_versions.get(key, 0) != version, timeout)
+
 def update_file_status(username, agent_name, filename, status, message=None):
-    """Update the status of a file in files.json"""
-    agent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', username, 'AGENTS', agent_name)
-    files_json_path = os.path.join(agent_dir, 'files.json')
-    
-    if not os.path.exists(files_json_path):
-        # If files.json doesn't exist, create it
-        files_data = {
-            "files": []
-        }
-    else:
-        # Load existing files.json
-        try:
-            with open(files_json_path, 'r') as f:
-                files_data = json.load(f)
-        except json.JSONDecodeError:
-            # If file is corrupted, create a new one
-            files_data = {
-                "files": []
-            }
-    
-    # Find the file in the list
-    file_found = False
-    for file in files_data['files']:
-        if file['name'] == filename:
-            file['processing_status'] = status
-            if message:
-                file['error_message'] = message
-            else:
-                file['error_message'] = None
-            
-            # If status is 'success', mark as processed
-            if status == 'success':
-                file['processed'] = True
-            
-            file_found = True
-            break
+    """Record a status change for a file by appending to the agent's files.jsonl"""
+    update_files_status(username, agent_name, [filename], status, message)
+
+@functools.lru_cache(maxsize=4096)
+def _files_log_path(username, agent_name):
+    """Path of an agent's files.jsonl, built once per agent"""
+    return os.path.join(DATA_DIR, username, 'AGENTS', agent_name, 'files.jsonl')
+
+def update_files_status(username, agent_name, filenames, status, message=None):
+    """Record the same status change for several files with a single append"""
+    files_log_path = _files_log_path(username, agent_name)
     
-    if not file_found:
-        # If file not found, add it with the given status
-        logging.warning(f"File {filename} not found in files.json for agent {agent_name}, adding it")
-        files_data['files'].append({
+    # Partial records: merged into each file's existing entry when the log is folded
+    records = []
+    for filename in filenames:
+        record = {
             "name": filename,
             "processing_status": status,
-            "processed": status == 'success',
             "error_message": message
-        })
-    
-    # Save the updated data
-    with open(files_json_path, 'w') as f:
-        json.dump(files_data, f, indent=2)
+        }
+        if status == 'success':
+            record['processed'] = True
+        records.append(record)
     
-    return files_data
+    # Shares the per-file lock with the request handlers in app.py (log compaction)
+    with locked(files_log_path):
+        append_json_lines(files_log_path, records)
+    notify_status_change(username, agent_name)
 
 # =============================================================================
 # BASIC EXTRACTION FUNCTIONS
 # =============================================================================
 def generate_file_hash(file_path: Path) -> str:
     """Generate SHA-256 hash of file for tracking changes."""
-    hasher = hashlib.sha256()
     with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(8192), b''):
-            hasher.update(chunk)
-    return hasher.hexdigest()
+        if hasattr(hashlib, 'file_digest'):
+            # Python 3.11+: read + update loop runs in C
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        # Older Pythons: hand the whole file to one update() via mmap
+        # (mmap can't map an empty file)
+        hasher = hashlib.sha256()
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                hasher.update(mm)
+        return hasher.hexdigest()
 
-def extract_pdf_metadata(pdf_reader: PyPDF2.PdfReader) -> Dict[str, Any]:
-    """Extract basic PDF metadata."""
-    metadata = pdf_reader.metadata if pdf_reader.metadata else {}
+def extract_pdf_metadata(pdf: Any) -> Dict[str, Any]:
+    """Extract basic PDF metadata from an open pdfplumber PDF."""
+    metadata = pdf.metadata or {}
     return {
-        'title': metadata.get('/Title', ''),
-        'author': metadata.get('/Author', ''),
-        'subject': metadata.get('/Subject', ''),
-        'creator': metadata.get('/Creator', ''),
-        'creation_date': metadata.get('/CreationDate', ''),
-        'page_count': len(pdf_reader.pages)
+        'title': metadata.get('Title', ''),
+        'author': metadata.get('Author', ''),
+        'subject': metadata.get('Subject', ''),
+        'creator': metadata.get('Creator', ''),
+        'creation_date': metadata.get('CreationDate', ''),
+        'page_count': len(pdf.pages)
     }
 
+# A page's words as parallel columns: texts plus NumPy arrays of their top/bottom edges
+PageWords = Tuple[List[str], np.ndarray, np.ndarray]
+
+def index_page_words(words: List[Dict]) -> PageWords:
+    """Columnize a page's extract_words() output once, for every table on the page."""
+    words = [word for word in words if word.get('text', '').strip()]
+    return (
+        [word['text'].strip() for word in words],
+        np.fromiter((word['top'] for word in words), dtype=np.float64, count=len(words)),
+        np.fromiter((word['bottom'] for word in words), dtype=np.float64, count=len(words))
+    )
+
 def get_table_context(page: Any, table_bbox: Tuple[float, float, float, float], 
-                     text_blocks: List[Dict]) -> Dict[str, Any]:
+                     page_words: PageWords) -> Dict[str, Any]:
     """Extract context around a table including headings and surrounding text."""
     table_top, table_bottom = table_bbox[1], table_bbox[3]
-    context = {
-        'potential_headings': [],
-        'text_before': [],
-        'text_after': []
-    }
+    texts, tops, bottoms = page_words
     
-    for block in text_blocks:
-        block_bbox = block.get('bbox')
-        if not block_bbox:
-            continue
-            
-        block_bottom = block_bbox[3]
-        block_top = block_bbox[1]
-        text = block.get('text', '').strip()
-        
-        if not text:
-            continue
-        
-        if block_bottom < table_top and block_bottom >= table_top - 50:
-            context['potential_headings'].append({
-                'text': text,
-                'distance': table_top - block_bottom
-            })
-        elif block_bottom < table_top:
-            context['text_before'].append(text)
-        elif block_top > table_bottom:
-            context['text_after'].append(text)
+    # Classify every word against the table in one vectorized pass (indices stay in reading order)
+    above = bottoms < table_top
+    near = above & (bottoms >= table_top - 50)
+    heading_idx = np.flatnonzero(near)
+    before_idx = np.flatnonzero(above & ~near)
+    after_idx = np.flatnonzero(tops > table_bottom)
     
-    context['potential_headings'].sort(key=lambda x: x['distance'])
-    headings = [h['text'] for h in context['potential_headings'][:2]]
+    # Closest two headings first; a stable sort keeps reading order between ties
+    closest = heading_idx[np.argsort(table_top - bottoms[heading_idx], kind='stable')[:2]]
     
     return {
-        'headings': headings,
-        'text_before': ' '.join(context['text_before'][-2:]),
-        'text_after': ' '.join(context['text_after'][:2])
+        'headings': [texts[i] for i in closest],
+        'text_before': ' '.join(texts[i] for i in before_idx[-2:]),
+        'text_after': ' '.join(texts[i] for i in after_idx[:2])
     }
 
 def process_table(table: List[List[Any]], table_bbox: Tuple[float, float, float, float], 
-                 page: Any, page_num: int, table_idx: int) -> Dict[str, Any]:
-    """Process a single table and its context."""
-    # Convert empty strings and whitespace-only strings to None
-    cleaned_table = []
-    for row in table:
-        cleaned_row = []
-        for cell in row:
-            if cell is None or (isinstance(cell, str) and cell.strip() == ''):
-                cleaned_row.append(None)
-            else:
-                cleaned_row.append(cell)
-        cleaned_table.append(cleaned_row)
+                 page: Any, page_num: int, table_idx: int,
+                 page_words: PageWords) -> Dict[str, Any]:
+    """Process a single table and its context (page_words: from index_page_words())."""
+    # Blank out empty/whitespace-only cells, padding ragged rows to a common width
+    width = max((len(row) for row in table), default=0)
+    cells = [
+        [None if cell is None or (isinstance(cell, str) and not cell.strip()) else cell
+         for cell in row] + [None] * (width - len(row))
+        for row in table
+    ]
     
-    # Create DataFrame from cleaned table
-    df = pd.DataFrame(cleaned_table)
+    # Remove completely empty columns and rows
+    kept_columns = [c for c in range(width) if any(row[c] is not None for row in cells)]
+    data = [
+        [row[c] for c in kept_columns] for row in cells
+        if any(row[c] is not None for c in kept_columns)
+    ]
+    columns = len(kept_columns) if data else 0
     
-    # Remove completely empty rows and columns
-    df = df.replace('', None).dropna(how='all', axis=1).dropna(how='all', axis=0)
-    
-    # Assign default column names if DataFrame is not empty
-    if not df.empty and len(df.columns) > 0:
-        df.columns = [f'Column_{i+1}' for i in range(len(df.columns))]
-    
-    text_blocks = page.extract_words(x_tolerance=3, y_tolerance=3, keep_blank_chars=False)
-    context = get_table_context(page, table_bbox, text_blocks)
-    
-    rows = len(df) if not df.empty else 0
-    columns = len(df.columns) if not df.empty else 0
-    headers = df.columns.tolist() if not df.empty else []
+    context = get_table_context(page, table_bbox, page_words)
     
     table_metadata = TableMetadata(
         table_id=table_idx + 1,
         page_number=page_num,
         bbox=list(table_bbox),
-        rows=rows,
+        rows=len(data),
         columns=columns,
-        headers=headers,
+        # Default column names
+        headers=[f'Column_{i+1}' for i in range(columns)],
         context_headings=context['headings'],
         text_before=context['text_before'],
         text_after=context['text_after']
     )
     
     return {
-        'metadata': asdict(table_metadata),
-        'data': df.values.tolist() if not df.empty else []
+        'metadata': table_metadata,
+        'data': data
     }
 
-def extract_page_content(page: Any, page_num: int) -> Dict[str, Any]:
-    """Extract content from a single page."""
+def extract_page_content(page: Any, page_num: int, text: Optional[str] = None) -> Dict[str, Any]:
+    """Extract content from a single page; `text` overrides pdfplumber's page text."""
     tables = []
-    page_tables = page.extract_tables()
+    # One table detection pass (extract_tables() would run find_tables() again internally)
+    found_tables = page.find_tables()
     
-    if page_tables:
-        table_positions = page.find_tables()
-        for idx, (table, position) in enumerate(zip(page_tables, table_positions)):
-            table_data = process_table(table, position.bbox, page, page_num, idx)
+    if found_tables:
+        # Word layout is the same for every table on the page, so compute it once
+        page_words = index_page_words(
+            page.extract_words(x_tolerance=3, y_tolerance=3, keep_blank_chars=False)
+        )
+        for idx, found in enumerate(found_tables):
+            table_data = process_table(found.extract(), found.bbox, page, page_num, idx, page_words)
             tables.append(table_data)
     
     return {
         'page_number': page_num,
-        'text': page.extract_text().strip(),
+        'text': (page.extract_text() if text is None else text).strip(),
         'tables': tables
     }
 
-def extract_document_content(pdf_path: Path) -> Optional[Dict[str, Any]]:
-    """Extract content and metadata from a PDF file."""
+# Page-level parallelism: pdfplumber's layout analysis is pure Python and CPU-bound, so
+# pages of larger PDFs are spread over worker processes (size via ZAPIENT_PAGE_WORKERS).
+# Smaller documents aren't worth the cost of reopening the PDF in another process.
+PAGE_WORKERS = int(os.getenv('ZAPIENT_PAGE_WORKERS', os.cpu_count() or 1))
+PARALLEL_PAGE_THRESHOLD = 4
+
+_page_pool: Optional[ProcessPoolExecutor] = None
+_page_pool_lock = threading.Lock()
+
+def _get_page_pool() -> ProcessPoolExecutor:
+    """Shared process pool for page extraction, started on first use."""
+    global _page_pool
+    with _page_pool_lock:
+        if _page_pool is None:
+            # forkserver/spawn: forking this multi-threaded server process is unsafe
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            _page_pool = ProcessPoolExecutor(max_workers=PAGE_WORKERS, mp_context=context)
+        return _page_pool
+
+def _discard_page_pool():
+    """Drop a broken pool so the next document starts a fresh one."""
+    global _page_pool
+    with _page_pool_lock:
+        if _page_pool is not None:
+            _page_pool.shutdown(wait=False, cancel_futures=True)
+            _page_pool = None
+
+def _iter_pages(pdf: Any, pdf_path: Path, first_page: int, last_page: int) -> Iterator[Dict[str, Any]]:
+    """Yield pages first_page..last_page (1-based, inclusive) of an open pdfplumber PDF."""
+    text_doc = fitz.open(str(pdf_path)) if HAS_PYMUPDF else None
     try:
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            basic_metadata = extract_pdf_metadata(pdf_reader)
-        
+        for page_num in range(first_page, last_page + 1):
+            yield extract_page_content(
+                pdf.pages[page_num - 1], page_num,
+                text_doc[page_num - 1].get_text() if text_doc is not None else None
+            )
+    finally:
+        if text_doc is not None:
+            text_doc.close()
+
+def _extract_page_range(pdf_path: str, first_page: int, last_page: int) -> List[Dict[str, Any]]:
+    """Worker-process entry point: extract a page range of the PDF at pdf_path."""
+    with pdfplumber.open(pdf_path) as pdf:
+        return list(_iter_pages(pdf, Path(pdf_path), first_page, last_page))
+
+# Pages per pool task. Small ranges keep the results waiting in the parent bounded
+# while they are streamed to disk, at the cost of reopening the PDF per range.
+PAGES_PER_TASK = 16
+
+def _iter_pages_parallel(pdf_path: Path, page_count: int) -> Iterator[Dict[str, Any]]:
+    """Yield all pages in order, extracting contiguous page ranges across the process pool."""
+    pool = _get_page_pool()
+    per_task = max(1, min(-(-page_count // PAGE_WORKERS), PAGES_PER_TASK))
+    futures = deque(
+        pool.submit(_extract_page_range, str(pdf_path), first, min(first + per_task - 1, page_count))
+        for first in range(1, page_count + 1, per_task)
+    )
+    try:
+        while futures:
+            # popleft() drops our reference so each range is freed once written
+            yield from futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+def iter_document_pages(pdf: Any, pdf_path: Path) -> Iterator[Dict[str, Any]]:
+    """Yield the extracted content of each page of an open pdfplumber PDF, in page order."""
+    page_count = len(pdf.pages)
+    next_page = 1
+    
+    if PAGE_WORKERS > 1 and page_count >= PARALLEL_PAGE_THRESHOLD:
+        try:
+            for page_content in _iter_pages_parallel(pdf_path, page_count):
+                yield page_content
+                next_page += 1
+        except (BrokenProcessPool, OSError) as e:
+            _discard_page_pool()
+            logging.warning(f"Parallel page extraction unavailable for {pdf_path.name}, "
+                            f"falling back to sequential from page {next_page}: {str(e)}")
+    
+    yield from _iter_pages(pdf, pdf_path, next_page, page_count)
+
+def extract_document_content(pdf_path: Path, out: BinaryIO) -> Optional[Tuple[DocumentMetadata, str]]:
+    """
+    Extract content and metadata from a PDF file, streaming each page into `out`
+    as a comma-separated JSON array item so whole documents never sit in memory.
+    Returns the metadata and the leading page text (enough for truncate_text()).
+    """
+    try:
+        # One parse of the PDF serves both the document info dict and the pages
         with pdfplumber.open(pdf_path) as pdf:
-            content = []
-            all_tables = []
-            
-            for page_num, page in enumerate(pdf.pages, 1):
-                page_content = extract_page_content(page, page_num)
-                content.append(page_content)
-                all_tables.extend(page_content['tables'])
+            basic_metadata = extract_pdf_metadata(pdf)
             
-            doc_metadata = DocumentMetadata(
-                filename=pdf_path.name,
-                file_path=str(pdf_path),
-                file_hash=generate_file_hash(pdf_path),
-                extraction_date=datetime.now().isoformat(),
-                title=basic_metadata['title'],
-                author=basic_metadata['author'],
-                subject=basic_metadata['subject'],
-                creator=basic_metadata['creator'],
-                creation_date=basic_metadata['creation_date'],
-                page_count=basic_metadata['page_count'],
-                total_tables=len(all_tables),
-                pages_with_tables=sum(1 for page in content if page['tables'])
-            )
+            total_tables = 0
+            pages_with_tables = 0
+            text_parts = []
+            text_length = -1  # length of ' '.join(text_parts)
             
-            return {
-                'metadata': asdict(doc_metadata),
-                'content': content
-            }
+            for page_content in iter_document_pages(pdf, pdf_path):
+                if page_content['page_number'] > 1:
+                    out.write(b',')
+                out.write(dumps(page_content))
+                
+                if page_content['tables']:
+                    total_tables += len(page_content['tables'])
+                    pages_with_tables += 1
+                # Keep just past the LLM limit so truncation matches the whole text's
+                if page_content['text'] and text_length <= LLM_TEXT_LIMIT:
+                    text_parts.append(page_content['text'])
+                    text_length += len(page_content['text']) + 1
+        
+        doc_metadata = DocumentMetadata(
+            filename=pdf_path.name,
+            file_path=str(pdf_path),
+            file_hash=generate_file_hash(pdf_path),
+            extraction_date=datetime.now().isoformat(),
+            title=basic_metadata['title'],
+            author=basic_metadata['author'],
+            subject=basic_metadata['subject'],
+            creator=basic_metadata['creator'],
+            creation_date=basic_metadata['creation_date'],
+            page_count=basic_metadata['page_count'],
+            total_tables=total_tables,
+            pages_with_tables=pages_with_tables
+        )
+        
+        return doc_metadata, ' '.join(text_parts)
             
     except Exception as e:
         logging.error(f"Error processing {pdf_path}: {str(e)}")
@@ -334,8 +447,9 @@ def extract_document_content(pdf_path: Path) -> Optional[Dict[str, Any]]:
 # ADVANCED METADATA EXTRACTION
 # =============================================================================
 if HAS_GEMINI:
+    @functools.lru_cache(maxsize=1)
     def setup_gemini(api_key: str) -> genai.GenerativeModel:
-        """Initialize and return Gemini model."""
+        """Initialize and return Gemini model (built once and reused while the key is unchanged)."""
         genai.configure(api_key=api_key)
         
         # Configure the model with recommended settings
@@ -344,11 +458,16 @@ if HAS_GEMINI:
             "top_p": 0.95,
             "top_k": 40,
             "max_output_tokens": 8192,
+            # JSON mode: the reply is the metadata object itself
+            "response_mime_type": "application/json",
         }
         
+        # SYSTEM_PROMPT is fixed, so it is set once on the model rather than sent per
+        # document. It is far below the minimum size for explicit context caching.
         return genai.GenerativeModel(
             model_name="gemini-1.5-flash",
-            generation_config=generation_config
+            generation_config=generation_config,
+            system_instruction=SYSTEM_PROMPT
         )
 
     def validate_metadata(metadata: Dict[str, Any]) -> None:
@@ -384,47 +503,23 @@ if HAS_GEMINI:
 
     @retry(stop=stop_after_attempt(2), wait=wait_exponential(multiplier=1, min=2, max=5))
     def extract_metadata(model: genai.GenerativeModel, text: str) -> Dict[str, Any]:
-        """Extract metadata from document text using Gemini chat."""
+        """Extract metadata from document text using Gemini."""
         try:
-            # Try to use chat API first
-            try:
-                # Start a new chat session
-                chat = model.start_chat(history=[])
-                
-                # Send system prompt first
-                chat.send_message(SYSTEM_PROMPT)
-                
-                # Send document text and get response
-                response = chat.send_message(f"Document Text:\n{text}")
-                response_text = response.text.strip()
-            except Exception as chat_error:
-                logging.warning(f"Chat API failed, falling back to generate_content: {str(chat_error)}")
-                # Fallback to generate_content if chat API fails
-                response = model.generate_content([
-                    SYSTEM_PROMPT, 
-                    f"Document Text:\n{text}"
-                ])
-                response_text = response.text.strip()
+            # One request per document: the instructions ride along as the model's
+            # system instruction instead of a separate chat turn
+            response = model.generate_content(f"Document Text:\n{text}")
+            response_text = response.text.strip()
             
-            # Try to find JSON in the response
+            # JSON mode replies are bare JSON; the regex covers a reply that still
+            # wraps it in text (one scan from the first '{' to the last '}')
             try:
-                # First try direct JSON parsing
-                metadata = json.loads(response_text)
+                metadata = loads(response_text)
             except json.JSONDecodeError:
-                # If that fails, try to find JSON-like structure
-                start_idx = response_text.find('{')
-                end_idx = response_text.rfind('}')
-                
-                if start_idx != -1 and end_idx != -1:
-                    json_str = response_text[start_idx:end_idx + 1]
-                    try:
-                        metadata = json.loads(json_str)
-                    except json.JSONDecodeError:
-                        logging.error(f"Could not extract valid JSON from response")
-                        raise
-                else:
+                match = _JSON_OBJECT_RE.search(response_text)
+                if not match:
                     logging.error("No JSON structure found in response")
                     raise ValueError("Response does not contain JSON structure")
+                metadata = loads(match.group(0))
             
             # Validate response structure
             validate_metadata(metadata)
@@ -435,7 +530,7 @@ if HAS_GEMINI:
             logging.error(f"Error in metadata extraction: {str(e)}")
             raise
 
-    def truncate_text(text: str, max_length: int = 30000) -> str:
+    def truncate_text(text: str, max_length: int = LLM_TEXT_LIMIT) -> str:
         """Truncate text to max_length while keeping whole sentences."""
         if len(text) <= max_length:
             return text
@@ -456,10 +551,13 @@ def process_document_full(
     api_key: str,
     username: str = None,
     agent_name: str = None,
-    filename: str = None
+    filename: str = None,
+    processed_stems: Optional[Set[str]] = None
 ) -> Dict[str, str]:
     """
     Process a PDF document with both basic and advanced extraction.
+    processed_stems: stems of processed_dir's .json files, if the caller already
+    scanned it; otherwise the output file is checked directly.
     
     Returns a dictionary with processing status information.
     """
@@ -475,7 +573,8 @@ def process_document_full(
         
         # Check if file is already processed
         output_path = processed_dir / f"{pdf_path.stem}.json"
-        if output_path.exists():
+        if (pdf_path.stem in processed_stems if processed_stems is not None
+                else output_path.exists()):
             # File already processed, return success
             result['status'] = 'success'
             result['message'] = f"File {pdf_path.name} already processed"
@@ -487,23 +586,6 @@ def process_document_full(
                 
             return result
         
-        # Step 1: Basic extraction
-        logging.info(f"Starting extraction for {pdf_path.name}")
-        
-        # Update status if username and agent_name are provided
-        if username and agent_name and filename:
-            update_file_status(username, agent_name, filename, 'processing', 'Extracting document content')
-        
-        document = extract_document_content(pdf_path)
-        if not document:
-            result['message'] = f"Failed to extract content from {pdf_path.name}"
-            
-            # Update status if username and agent_name are provided
-            if username and agent_name and filename:
-                update_file_status(username, agent_name, filename, 'error', f"Failed to extract content from {pdf_path.name}")
-                
-            return result
-        
         # Default fallback metadata in case Gemini fails
         fallback_metadata = {
             "intent": "Technical",
@@ -525,49 +607,62 @@ def process_document_full(
             "key_sections": ["Main document sections"]
         }
         
-        # Step 2: Try advanced extraction with Gemini
-        gemini_success = False
-        if HAS_GEMINI and api_key:
-            logging.info(f"Performing advanced extraction for {pdf_path.name}")
+        # Step 1: Basic extraction, streamed into the output file page by page.
+        # atomic_writer only swaps the file into place if the whole block succeeds.
+        logging.info(f"Starting extraction for {pdf_path.name}")
+        
+        # Update status if username and agent_name are provided
+        if username and agent_name and filename:
+            update_file_status(username, agent_name, filename, 'processing', 'Extracting document content')
+        
+        with atomic_writer(output_path) as out:
+            out.write(b'{"content":[')
+            extracted = extract_document_content(pdf_path, out)
+            if not extracted:
+                # Reported (and the partial file discarded) by the handler below
+                raise ValueError(f"Failed to extract content from {pdf_path.name}")
+            doc_metadata, leading_text = extracted
+            document = {'metadata': doc_metadata}
             
-            # Update status if username and agent_name are provided
-            if username and agent_name and filename:
-                update_file_status(username, agent_name, filename, 'processing', 'Performing advanced metadata extraction')
-                
-            try:
-                # Extract text content from all pages
-                full_text = ' '.join(
-                    page['text'] for page in document['content']
-                    if page.get('text')
-                )
-                
-                # Truncate text if too long
-                full_text = truncate_text(full_text)
-                
-                # Setup Gemini model
-                model = setup_gemini(api_key)
-                
-                # Extract advanced metadata
-                advanced_metadata = extract_metadata(model, full_text)
+            # Step 2: Try advanced extraction with Gemini
+            gemini_success = False
+            if HAS_GEMINI and api_key:
+                logging.info(f"Performing advanced extraction for {pdf_path.name}")
                 
-                # Add advanced metadata to document
-                document['advanced_metadata'] = advanced_metadata
-                gemini_success = True
-                
-            except Exception as e:
-                logging.error(f"Advanced processing failed for {pdf_path.name}: {str(e)}")
-                document['advanced_processing_error'] = str(e)
-                # Use fallback metadata
+                # Update status if username and agent_name are provided
+                if username and agent_name and filename:
+                    update_file_status(username, agent_name, filename, 'processing', 'Performing advanced metadata extraction')
+                    
+                try:
+                    # Truncate text if too long
+                    full_text = truncate_text(leading_text)
+                    
+                    # Setup Gemini model
+                    model = setup_gemini(api_key)
+                    
+                    # Extract advanced metadata
+                    advanced_metadata = extract_metadata(model, full_text)
+                    
+                    # Add advanced metadata to document
+                    document['advanced_metadata'] = advanced_metadata
+                    gemini_success = True
+                    
+                except Exception as e:
+                    logging.error(f"Advanced processing failed for {pdf_path.name}: {str(e)}")
+                    document['advanced_processing_error'] = str(e)
+                    # Use fallback metadata
+                    document['advanced_metadata'] = fallback_metadata
+                    document['used_fallback_metadata'] = True
+            else:
+                document['advanced_processing_error'] = "Gemini API not available or API key not provided"
                 document['advanced_metadata'] = fallback_metadata
                 document['used_fallback_metadata'] = True
-        else:
-            document['advanced_processing_error'] = "Gemini API not available or API key not provided"
-            document['advanced_metadata'] = fallback_metadata
-            document['used_fallback_metadata'] = True
             
-        # Save complete document
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(document, f, ensure_ascii=False, indent=2)
+            # Save complete document: close the content array, then the remaining keys
+            out.write(b']')
+            for key, value in document.items():
+                out.write(b',' + dumps(key) + b':' + dumps(value))
+            out.write(b'}')
             
         result['status'] = 'success'
         if gemini_success:
@@ -595,22 +690,29 @@ def process_files_batch(
     processed_dir: Path,
     api_key: str,
     username: str = None,
-    agent_name: str = None
+    agent_name: str = None,
+    processed_stems: Optional[Set[str]] = None
 ) -> Dict[str, Dict[str, str]]:
     """
-    Process a batch of PDF files.
+    Process a batch of PDF files, several at a time (each file's work is
+    dominated by PDF parsing in worker processes and the Gemini round trip).
     
     Returns a dictionary with results for each file.
     """
-    results = {}
+    def process_pdf(file_path: Path) -> Dict[str, str]:
+        logging.info(f"Processing {file_path.name}")
+        return process_document_full(
+            file_path, processed_dir, api_key, 
+            username=username, agent_name=agent_name, filename=file_path.name,
+            processed_stems=processed_stems
+        )
     
+    results = {}
+    pdf_files = []
     for file_path in files:
         if file_path.suffix.lower() == '.pdf':
-            logging.info(f"Processing {file_path.name}")
-            results[file_path.name] = process_document_full(
-                file_path, processed_dir, api_key, 
-                username=username, agent_name=agent_name, filename=file_path.name
-            )
+            pdf_files.append(file_path)
+            results[file_path.name] = None  # filled in below, keeping input order
         else:
             logging.warning(f"Skipping non-PDF file: {file_path.name}")
             results[file_path.name] = {
@@ -622,11 +724,60 @@ def process_files_batch(
             if username and agent_name:
                 update_file_status(username, agent_name, file_path.name, 'error', 'Not a PDF file')
     
+    if len(pdf_files) > 1:
+        # A private pool: callers may already be running on _pdf_pool
+        with ThreadPoolExecutor(max_workers=min(PDF_WORKERS, len(pdf_files)),
+                                thread_name_prefix='pdf-batch') as pool:
+            pdf_results = list(pool.map(process_pdf, pdf_files))
+    else:
+        pdf_results = [process_pdf(file_path) for file_path in pdf_files]
+    
+    for file_path, result in zip(pdf_files, pdf_results):
+        results[file_path.name] = result
+    
     return results
 
 # =============================================================================
 # BACKGROUND PROCESSING FUNCTION
 # =============================================================================
+# Shared, bounded pool for background PDF processing (size via ZAPIENT_PDF_WORKERS).
+# Defaults to one worker per CPU, but at least 2 so a long file can't starve the queue.
+PDF_WORKERS = int(os.getenv('ZAPIENT_PDF_WORKERS', max(2, os.cpu_count() or 4)))
+_pdf_pool = ThreadPoolExecutor(max_workers=PDF_WORKERS, thread_name_prefix='pdf-worker')
+
+def process_agent_file(
+    username: str,
+    agent_name: str,
+    agent_dir: str,
+    filename: str,
+    api_key: str = None,
+    processed_stems: Optional[Set[str]] = None
+) -> Dict[str, str]:
+    """Process a single uploaded file for an agent. Returns its processing result."""
+    file_path = Path(agent_dir) / 'uploads' / filename
+    results = process_files_batch(
+        [file_path],
+        Path(agent_dir) / 'processed',
+        api_key,
+        username=username,
+        agent_name=agent_name,
+        processed_stems=processed_stems
+    )
+    return results[file_path.name]
+
+def _finalize_agent_config(config_file: str, results: Dict[str, Dict[str, str]], error: Optional[str]):
+    """Record the outcome of a processing run in the agent's config.json."""
+    def record_outcome(config):
+        config['processing_complete'] = True
+        if error is None:
+            config['files_processed'] = True
+            config['processing_results'] = results
+        else:
+            config['files_processed'] = False
+            config['processing_error'] = error
+
+    update_json(config_file, record_outcome)
+
 def process_agent_files(
     username: str,
     agent_name: str,
@@ -634,64 +785,61 @@ def process_agent_files(
     files: List[str],
     config_file: str,
     api_key: str = None
-):
-    """Process files for an agent in the background."""
-    try:
-        # Setup paths
-        uploads_dir = os.path.join(agent_dir, 'uploads')
-        processed_dir = os.path.join(agent_dir, 'processed')
-        
-        # Create directories if they don't exist
-        os.makedirs(processed_dir, exist_ok=True)
-        
-        # Get file paths as Path objects
-        file_paths = [Path(os.path.join(uploads_dir, f)) for f in files]
-        
-        # Update status for all files to 'processing'
-        for filename in files:
-            update_file_status(username, agent_name, filename, 'processing', 'Processing document content')
-        
-        # Process files
-        results = process_files_batch(
-            file_paths,
-            Path(processed_dir),
-            api_key,
-            username=username,
-            agent_name=agent_name
-        )
+) -> List[Future]:
+    """
+    Process files for an agent in the background.
+    
+    Each file is submitted to the shared worker pool; the agent config is updated
+    once the last file finishes. Returns the per-file futures without blocking.
+    """
+    processed_dir = os.path.join(agent_dir, 'processed')
+    os.makedirs(processed_dir, exist_ok=True)
+    
+    if not files:
+        return []
+    
+    # One directory scan answers "already processed?" for every file (read-only, shared by the workers)
+    with os.scandir(processed_dir) as it:
+        processed_stems = frozenset(entry.name[:-5] for entry in it if entry.name.endswith('.json'))
+    
+    # Update status for all files to 'processing'
+    update_files_status(username, agent_name, files, 'processing', 'Processing document content')
+    
+    futures = {
+        filename: _pdf_pool.submit(process_agent_file, username, agent_name, agent_dir, filename, api_key,
+                                   processed_stems)
+        for filename in files
+    }
+    remaining = [len(futures)]
+    remaining_lock = threading.Lock()
+    
+    def on_file_done(_future: Future):
+        with remaining_lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
         
+        # Last file finished: collect results and update the agent config.
         # We don't need to update file status here as process_document_full already does it
+        results = {}
+        error = None
+        for filename, future in futures.items():
+            exc = future.exception()
+            if exc is None:
+                results[filename] = future.result()
+            else:
+                logging.error(f"Error in file processing worker: {str(exc)}")
+                update_file_status(username, agent_name, filename, 'error', f"Processing error: {str(exc)}")
+                error = str(exc)
         
-        # Update agent config to indicate processing is complete
-        with open(config_file, 'r') as f:
-            config = json.load(f)
-        
-        config['files_processed'] = True
-        config['processing_complete'] = True
-        config['processing_results'] = results
-        
-        with open(config_file, 'w') as f:
-            json.dump(config, f)
-        
-        logging.info(f"Completed processing {len(files)} files for agent {agent_name}")
-            
-    except Exception as e:
-        logging.error(f"Error in file processing thread: {str(e)}")
-        
-        # Update status for all files to 'error'
-        for filename in files:
-            update_file_status(username, agent_name, filename, 'error', f"Processing error: {str(e)}")
-        
-        # Update agent config to indicate processing failed
         try:
-            with open(config_file, 'r') as f:
-                config = json.load(f)
-            
-            config['files_processed'] = False
-            config['processing_complete'] = True
-            config['processing_error'] = str(e)
-            
-            with open(config_file, 'w') as f:
-                json.dump(config, f)
+            _finalize_agent_config(config_file, results, error)
+            logging.info(f"Completed processing {len(files)} files for agent {agent_name}")
         except Exception as config_error:
-            logging.error(f"Error updating agent config: {str(config_error)}")
\ No newline at end of file
+            logging.error(f"Error updating agent config: {str(config_error)}")
+        notify_status_change(username, agent_name)
+    
+    for future in futures.values():
+        future.add_done_callback(on_file_done)
+    
+    return list(futures.values())
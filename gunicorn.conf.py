@@ -0,0 +1,33 @@
+# gunicorn.conf.py
+
+"""
+Production server settings, picked up automatically by `gunicorn app:app`
+when run from the project root. Worker processes share DATA_DIR; writes
+to it are coordinated with flock() (see json_utils.locked), so set
+ZAPIENT_DATA_DIR to a filesystem every worker can see and lock.
+"""
+
+import os
+import threading
+import multiprocessing
+
+bind = os.environ.get('ZAPIENT_BIND', '127.0.0.1:8000')
+
+# Threaded workers: uploads, file downloads and the processing-status
+# SSE streams are I/O-bound and can hold a thread for a long time. An SSE
+# stream holds its thread only while the agent has files pending or
+# processing (at most STATUS_STREAM_MAX_SECONDS per connection); raise
+# ZAPIENT_THREADS if many users watch uploads at once on few workers
+worker_class = 'gthread'
+workers = int(os.environ.get('ZAPIENT_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('ZAPIENT_THREADS', 4))
+
+# Heartbeat files in tmpfs so a slow disk can't make workers look hung
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def post_worker_init(worker):
+    # Load the embedding model in the background so a worker's first chat turn
+    # doesn't pay for it (retrieval waits on the same load if it gets there first)
+    from retrieval_engine import load_embedding_model
+    threading.Thread(target=load_embedding_model, name='embedding-preload', daemon=True).start()
@@ -0,0 +1,202 @@
+# json_utils.py
+
+"""
+Shared JSON (de)serialization for the files under data/ and for API responses.
+Uses orjson when it is installed and falls back to the stdlib json module.
+Also provides the lock used to make read-modify-write cycles on those files atomic.
+"""
+
+import os
+import json
+import mmap
+import dataclasses
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: in-process locking only
+    fcntl = None
+
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# JSON-Lines reads at least this large are parsed from an mmap (which has a fixed setup cost)
+MMAP_MIN_BYTES = 256 * 1024
+
+# orjson.JSONDecodeError subclasses this, so callers can catch one type either way
+JSONDecodeError = json.JSONDecodeError
+
+
+def loads(raw):
+    """Parse JSON from bytes or str"""
+    return orjson.loads(raw) if HAS_ORJSON else json.loads(raw)
+
+
+def _encode_default(obj):
+    """stdlib fallback for the types orjson serializes natively"""
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return dataclasses.asdict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(data, indent=False) -> bytes:
+    """
+    Serialize data to UTF-8 JSON bytes, optionally 2-space indented.
+    Dataclass instances are serialized as objects, so callers needn't asdict() them first.
+    """
+    if HAS_ORJSON:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(data, indent=2 if indent else None, ensure_ascii=False,
+                      default=_encode_default).encode('utf-8')
+
+
+def read_json(path):
+    """Load a JSON file from disk"""
+    with open(path, 'rb') as f:
+        return loads(f.read())
+
+
+@contextmanager
+def atomic_writer(path):
+    """
+    Yield a binary file that replaces `path` atomically when the block exits:
+    it is a temp file in the same directory, fsynced and then os.replace()d over
+    the target. If the block raises, the temp file is removed and `path` is left
+    untouched, so large outputs can be streamed without readers seeing a partial file.
+    """
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    try:
+        with open(tmp_path, 'wb') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def atomic_write_bytes(path, payload):
+    """
+    Replace the file at `path` with `payload` atomically. Readers see
+    either the old or the new contents, never a truncated file.
+    """
+    with atomic_writer(path) as f:
+        f.write(payload)
+
+
+def write_json(path, data, indent=True):
+    """Write data to a JSON file on disk (atomically)"""
+    atomic_write_bytes(path, dumps(data, indent=indent))
+
+
+def _load_line(line, path):
+    """Parse one JSON-Lines record, or None for a blank or torn line"""
+    try:
+        return loads(line)
+    except json.JSONDecodeError:
+        if bytes(line).strip():
+            logging.warning(f"Skipping corrupt line in {path}")
+        return None
+
+
+def read_json_lines(path, start=0, end=None):
+    """
+    Load the records of a JSON-Lines file, skipping blank or torn lines.
+    `start`/`end` restrict the read to a byte range, e.g. just the lines
+    appended since the file was last read. Large ranges are parsed straight
+    out of an mmap of the file rather than copied through read buffers.
+    """
+    records = []
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        stop = size if end is None else min(end, size)
+        if stop - start >= MMAP_MIN_BYTES:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                pos = start
+                while pos < stop:
+                    newline = mm.find(b'\n', pos, stop)
+                    line_end = stop if newline == -1 else newline
+                    if line_end > pos:
+                        # orjson parses the memoryview in place; stdlib json needs bytes
+                        with view[pos:line_end] as line:
+                            record = _load_line(line if HAS_ORJSON else bytes(line), path)
+                        if record is not None:
+                            records.append(record)
+                    pos = line_end + 1
+            return records
+
+        if start:
+            f.seek(start)
+        lines = f if end is None else f.read(end - start).splitlines()
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            record = _load_line(line, path)
+            if record is not None:
+                records.append(record)
+    return records
+
+
+def append_json_lines(path, records):
+    """Append records to a JSON-Lines file with a single O_APPEND write"""
+    payload = b''.join(dumps(record) + b'\n' for record in records)
+    with open(path, 'ab') as f:
+        f.write(payload)
+
+
+def write_json_lines(path, records):
+    """Rewrite a JSON-Lines file, swapping it into place atomically"""
+    atomic_write_bytes(path, b''.join(dumps(record) + b'\n' for record in records))
+
+
+# One lock per file path so unrelated agents never serialize on each other
+_path_locks = defaultdict(threading.Lock)
+_path_locks_guard = threading.Lock()
+
+
+@contextmanager
+def locked(path):
+    """
+    Hold an exclusive lock on `path` for a read-modify-write cycle.
+    Threads are serialized with a per-path lock and processes with flock()
+    on a `<path>.lock` sidecar, so the data file itself can be rewritten freely.
+    Not reentrant: don't nest two `locked()` calls on the same path.
+    """
+    key = os.path.abspath(path)
+    with _path_locks_guard:
+        thread_lock = _path_locks[key]
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(key + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            # Closing the descriptor releases the flock
+            os.close(fd)
+
+
+def update_json(path, mutate):
+    """
+    Apply `mutate` to the object stored in a JSON file and write it back,
+    holding locked(path) so concurrent writers in any process can't lose updates.
+    Returns the updated object.
+    """
+    with locked(path):
+        data = read_json(path)
+        mutate(data)
+        write_json(path, data)
+    return data
@@ -1,14 +1,20 @@
 # prompt_analyzer.py
 
 import os
-import json
+import copy
+import functools
+import time
 import logging
+import threading
+from collections import OrderedDict, defaultdict
 from typing import Optional
 from threading import Thread
 
+from json_utils import loads
+
 from retrieval_engine import (
-    RetrievalEngine,
-    save_retrieval_results
+    get_retrieval_engine,
+    save_retrieval_results_bulk
 )
 
 PROMPT_ANALYSIS_SYSTEM_PROMPT = """You are a specialized assistant for analyzing a user's query.
@@ -26,6 +32,55 @@ Constraints:
 3. Do not enclose JSON in backticks.
 """
 
+# Cache of prompt analyses: a query that matches a recent one from the same user up to
+# case and whitespace reuses that analysis instead of calling Gemini. Only exact matches
+# are reused: a merely similar query (another entity, number or a negation) needs its
+# own sub-queries and keywords
+PROMPT_CACHE_SIZE = 256          # analyses kept per user
+PROMPT_CACHE_TTL_SECONDS = 3600
+
+
+def _normalize_query(user_query: str) -> str:
+    """Cache key of a query: casefolded, with runs of whitespace collapsed."""
+    return ' '.join(user_query.split()).casefold()
+
+
+class PromptAnalysisCache:
+    """
+    Recent prompt analyses per scope (user), keyed by normalized query text.
+    In memory only; entries expire after a TTL and the oldest are evicted first.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = defaultdict(OrderedDict)
+        self._lock = threading.Lock()
+
+    def get(self, scope: str, key: str) -> Optional[dict]:
+        """Return a copy of the cached analysis for `key`, if it hasn't expired."""
+        with self._lock:
+            entries = self._entries.get(scope)
+            entry = entries.get(key) if entries else None
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic() - self.ttl:
+                del entries[key]
+                return None
+            return copy.deepcopy(entry[1])
+
+    def put(self, scope: str, key: str, analysis: dict):
+        with self._lock:
+            entries = self._entries[scope]
+            entries.pop(key, None)
+            entries[key] = (time.monotonic(), copy.deepcopy(analysis))
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+
+_analysis_cache = PromptAnalysisCache(PROMPT_CACHE_SIZE, PROMPT_CACHE_TTL_SECONDS)
+
+
 ########################
 # Gemini Setup
 ########################
@@ -37,7 +92,39 @@ except ImportError:
     logging.error("Gemini python package (google-generativeai) not installed.")
 
 
-def analyze_prompt_with_gemini(api_key: str, user_query: str) -> dict:
+def _fallback_analysis(user_query: str) -> dict:
+    return {
+        "original_query": user_query,
+        "sub_queries": [user_query],
+        "keywords": []
+    }
+
+
+@functools.lru_cache(maxsize=1)
+def _analysis_model(api_key: str):
+    """Gemini model for prompt analysis, built once while the key is unchanged."""
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(
+        model_name="gemini-1.5-flash",
+        system_instruction=PROMPT_ANALYSIS_SYSTEM_PROMPT,
+        generation_config={
+            "temperature": 0.7,
+            "top_p": 0.95,
+            "top_k": 40,
+            "max_output_tokens": 2048,
+            # JSON mode: the reply is the JSON object itself
+            "response_mime_type": "application/json",
+        }
+    )
+
+
+def _request_analysis(api_key: str, user_query: str) -> dict:
+    """One Gemini prompt analysis (a single request); raises on an invalid reply."""
+    response = _analysis_model(api_key).generate_content(f"User Query:\n{user_query}")
+    return loads(response.text)
+
+
+def analyze_prompt_with_gemini(api_key: str, user_query: str, cache_scope: Optional[str] = None) -> dict:
     """
     Calls Gemini to analyze the user's query, splitting it into sub-queries
     and extracting keywords.
@@ -48,53 +135,30 @@ def analyze_prompt_with_gemini(api_key: str, user_query: str) -> dict:
         "keywords": [...]
       }
     or a fallback structure on error.
+    With a cache_scope (e.g. the username), a recent analysis of the same query
+    (up to case and whitespace) in that scope is reused instead of calling Gemini.
     """
-    if not HAS_GEMINI:
-        # fallback
-        return {
-            "original_query": user_query,
-            "sub_queries": [user_query],
-            "keywords": []
-        }
+    if not HAS_GEMINI or not api_key:
+        # fallback: no request that can only fail
+        return _fallback_analysis(user_query)
 
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel(
-        model_name="gemini-1.5-flash",
-        generation_config={
-            "temperature": 0.7,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 2048,
-        }
-    )
-    try:
-        chat_session = model.start_chat(history=[])
-        chat_session.send_message(PROMPT_ANALYSIS_SYSTEM_PROMPT)
-
-        response = chat_session.send_message(f"User Query:\n{user_query}")
-        response_text = response.text.strip()
-
-        # Try direct parse
-        try:
-            analysis = json.loads(response_text)
-            return analysis
-        except json.JSONDecodeError:
-            # Or substring extraction if there's extra text
-            start_idx = response_text.find('{')
-            end_idx = response_text.rfind('}')
-            if start_idx != -1 and end_idx != -1:
-                json_str = response_text[start_idx:end_idx + 1]
-                return json.loads(json_str)
-            else:
-                raise ValueError("No valid JSON found in Gemini response.")
+    cache_key = _normalize_query(user_query) if cache_scope is not None else None
+    if cache_key is not None:
+        cached = _analysis_cache.get(cache_scope, cache_key)
+        if cached is not None:
+            cached["original_query"] = user_query
+            return cached
 
+    try:
+        analysis = _request_analysis(api_key, user_query)
     except Exception as e:
         logging.error(f"Gemini prompt analysis error: {e}")
-        return {
-            "original_query": user_query,
-            "sub_queries": [user_query],
-            "keywords": []
-        }
+        return _fallback_analysis(user_query)
+
+    # Only real Gemini analyses are cached, never the fallback
+    if cache_key is not None:
+        _analysis_cache.put(cache_scope, cache_key, analysis)
+    return analysis
 
 
 def perform_retrieval_for_analysis(
@@ -107,76 +171,47 @@ def perform_retrieval_for_analysis(
     """
     1) Build a retrieval engine from the agent's processed/ folder
     2) For each sub-query and original_query => do SEMANTIC search (10 large chunks)
-    3) For the original_query => do KEYWORD search (25 small chunks)
-    4) Save (merge) results in retrieval_results.json
+    3) For the original_query => do KEYWORD search (25 small chunks, hybrid-reranked)
+    4) Save (append) results to retrieval_results.jsonl
     """
 
     agent_processed_dir = os.path.join(data_dir, username, 'AGENTS', agent_name, 'processed')
-    if not os.path.exists(agent_processed_dir):
+    # Reuses the agent's engine (chunks + embeddings) until processed/ changes;
+    # its stat of the folder doubles as the existence check
+    try:
+        engine = get_retrieval_engine(agent_processed_dir)
+    except FileNotFoundError:
         logging.warning(f"No processed folder for agent {agent_name}; skipping retrieval.")
         return
 
-    engine = RetrievalEngine(agent_processed_dir)
-
     original_q = analysis_result.get("original_query", "").strip()
     sub_qs = analysis_result.get("sub_queries", [])
 
     # -------------------------------------------
     # (2) SEMANTIC search for each query
-    all_queries = [original_q] + sub_qs
-    for q in all_queries:
+    # Sub-queries often repeat the original or each other up to case/whitespace;
+    # search each distinct query once (the first spelling is the one stored)
+    distinct = {}
+    for q in [original_q] + sub_qs:
         q_str = q.strip()
-        if not q_str:
-            continue
-        semantic_chunks = engine.semantic_search(q_str)
-        save_retrieval_results(
-            data_dir=data_dir,
-            username=username,
-            agent_name=agent_name,
-            conversation_id=conversation_id,
-            query=q_str,
-            semantic_chunks=semantic_chunks,
-            keyword_chunks=[]
-        )
-
-    # -------------------------------------------
-    # (3) KEYWORD search only for the original query
+        if q_str:
+            distinct.setdefault(' '.join(q_str.split()).casefold(), q_str)
+    all_queries = list(distinct.values())
+    # All queries are embedded in one batch
+    # (3) KEYWORD search only for the original query, reranked with its semantic ranking
     if original_q:
-        keyword_chunks = engine.keyword_search(original_q)
-        agent_dir = os.path.join(data_dir, username, 'AGENTS', agent_name)
-        retrieval_file = os.path.join(agent_dir, 'retrieval_results.json')
-        if os.path.exists(retrieval_file):
-            try:
-                with open(retrieval_file, 'r', encoding='utf-8') as f:
-                    retrieval_data = json.load(f)
-            except:
-                retrieval_data = {}
-        else:
-            retrieval_data = {}
-
-        if conversation_id not in retrieval_data:
-            retrieval_data[conversation_id] = {}
-
-        conv_dict = retrieval_data[conversation_id]
-        existing_entry = conv_dict.get(original_q, {})
-
-        existing_semantic = existing_entry.get("semantic_chunks", [])
-
-        def chunk_to_dict(ch):
-            return {
-                "text": ch.text,
-                "doc_filename": ch.doc_filename,
-                "page_number": ch.page_number,
-                "chunk_index": ch.chunk_index
-            }
-
-        keyword_list = [chunk_to_dict(ch) for ch in keyword_chunks]
-        updated_obj = {
-            "semantic_chunks": existing_semantic,
-            "keyword_chunks": keyword_list
-        }
-        conv_dict[original_q] = updated_obj
-        retrieval_data[conversation_id] = conv_dict
+        all_semantic_chunks, keyword_chunks = engine.hybrid_search(all_queries, original_q)
+    else:
+        all_semantic_chunks, keyword_chunks = engine.semantic_search_batch(all_queries), []
+    results = {q_str: (semantic_chunks, keyword_chunks if q_str == original_q else [])
+               for q_str, semantic_chunks in zip(all_queries, all_semantic_chunks)}
 
-        with open(retrieval_file, 'w', encoding='utf-8') as f:
-            json.dump(retrieval_data, f, indent=2)
\ No newline at end of file
+    # -------------------------------------------
+    # (4) One append to retrieval_results.jsonl for the whole turn
+    save_retrieval_results_bulk(
+        data_dir=data_dir,
+        username=username,
+        agent_name=agent_name,
+        conversation_id=conversation_id,
+        results=results
+    )
@@ -2,14 +2,32 @@
 
 import os
 import re
-import json
+import copy
+import hashlib
 import math
 import logging
-from typing import List, Dict, Any, Optional
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
 from pathlib import Path
 
+from json_utils import append_json_lines, atomic_writer, locked, read_json, read_json_lines, write_json_lines
+
+import numpy as np
+import torch
+from scipy import sparse
+
 # For local embeddings + semantic search (pip install sentence-transformers)
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import SentenceTransformer
+
+# Optional: Faiss vector index for semantic search (pip install faiss-cpu);
+# without it, search is a dense cosine-similarity scan (numpy BLAS on CPU, torch on GPU)
+try:
+    import faiss
+    HAS_FAISS = True
+except ImportError:
+    HAS_FAISS = False
 
 #########################
 # Configuration
@@ -24,6 +42,56 @@ TOP_K_KEYWORD = 25         # # of chunks to retrieve for keyword-based search
 
 # Which SentenceTransformer embedding model
 EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+# Run the model reduced-precision: FP16 weights on a GPU, dynamic int8 Linear layers on CPU.
+# Only used if, on a fixed sample, every embedding stays within QUANTIZE_MAX_COSINE_DELTA
+# (1 - cosine similarity) of the full-precision model's; otherwise the model stays FP32
+EMBEDDING_QUANTIZE = True
+QUANTIZE_MAX_COSINE_DELTA = 1e-3
+QUANTIZE_CHECK_SAMPLE = (
+    "What was the company's total revenue in fiscal year 2023?",
+    "Net income decreased by 12% compared to the prior year, mainly due to higher interest expense.",
+    "The agreement may be terminated by either party with ninety (90) days written notice.",
+    "Table 4: Operating cash flow by segment, in millions of USD",
+    "Patients in the treatment group reported fewer adverse events than the placebo group.",
+    "revenue",
+)
+# Chunks per forward pass when embedding an agent's documents; lower it if GPU memory is tight.
+# encode() already length-sorts its input, so each batch pads only to similar lengths
+EMBEDDING_BATCH_SIZE = 64
+
+# Faiss indexes are exact (flat inner product on normalized embeddings) below this many
+# large chunks; bigger corpora use an IVF index with sqrt(N) lists, probing IVF_NPROBE of them
+IVF_MIN_CHUNKS = 10000
+IVF_NPROBE = 8
+# From this many large chunks the IVF lists hold product-quantized codes (PQ_SUBVECTORS
+# bytes per vector instead of 4 per dimension); trained on at most IVF_TRAIN_SAMPLE vectors
+IVFPQ_MIN_CHUNKS = 200000
+PQ_SUBVECTORS = 32
+IVF_TRAIN_SAMPLE = 100000
+
+# BM25 parameters for keyword search: term-frequency saturation and length normalization
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Hybrid keyword search: BM25's top HYBRID_DEPTH small chunks are fused with the semantic
+# ranking of the HYBRID_DEPTH nearest large chunks by Reciprocal Rank Fusion (1 / (RRF_K + rank))
+HYBRID_DEPTH = 100
+RRF_K = 60
+
+# Threads reading and chunking an agent's processed documents in parallel
+# when an engine is built (size via ZAPIENT_INGEST_WORKERS)
+INGEST_WORKERS = int(os.getenv('ZAPIENT_INGEST_WORKERS', os.cpu_count() or 1))
+
+# Large-chunk embeddings are saved to <agent>/embedding_cache/<signature>.npy, keyed by the
+# processed files' names, sizes and mtimes, so a new process can skip re-encoding them
+EMBEDDING_CACHE_DIRNAME = 'embedding_cache'
+
+# Number of agents whose engines (chunks + embeddings) are kept in memory
+ENGINE_CACHE_SIZE = 8
+
+# retrieval_results.jsonl is compacted once it has this many lines and
+# more than twice as many as there are live (conversation, query) entries
+RETRIEVAL_COMPACT_MIN_LINES = 64
 
 #########################
 # Retrieval Classes & Functions
@@ -33,12 +101,172 @@ class ChunkData:
     """
     Holds the chunk's text, plus metadata about which doc/page/chunk_index it came from.
     """
+    # No per-instance __dict__: an engine holds one of these per chunk
+    __slots__ = ('text', 'doc_filename', 'page_number', 'chunk_index')
+
     def __init__(self, text: str, doc_filename: str, page_number: int, chunk_index: int):
         self.text = text
         self.doc_filename = doc_filename
         self.page_number = page_number
         self.chunk_index = chunk_index
 
+    def to_dict(self) -> dict:
+        """The chunk as stored in retrieval_results.jsonl"""
+        return {
+            "text": self.text,
+            "doc_filename": self.doc_filename,
+            "page_number": self.page_number,
+            "chunk_index": self.chunk_index
+        }
+
+
+def _quantize_model(model: SentenceTransformer) -> Tuple[SentenceTransformer, str]:
+    """
+    Return (model, precision): a copy of the model in FP16 (CUDA) or with int8 dynamic
+    quantization (CPU) if it embeds QUANTIZE_CHECK_SAMPLE within QUANTIZE_MAX_COSINE_DELTA
+    of the FP32 model, else the FP32 model itself.
+    """
+    reference = model.encode(list(QUANTIZE_CHECK_SAMPLE), convert_to_numpy=True, normalize_embeddings=True)
+    if model.device.type == 'cuda':
+        quantized, precision = copy.deepcopy(model).half(), 'fp16'
+    else:
+        # Linear layers hold nearly all of a transformer encoder's weights and FLOPs
+        quantized = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        precision = 'int8'
+    candidate = quantized.encode(list(QUANTIZE_CHECK_SAMPLE), convert_to_numpy=True, normalize_embeddings=True)
+
+    delta = float(np.max(1.0 - np.sum(np.asarray(reference, dtype=np.float32)
+                                      * np.asarray(candidate, dtype=np.float32), axis=1)))
+    if delta >= QUANTIZE_MAX_COSINE_DELTA:
+        logging.warning(f"Keeping the embedding model in FP32: {precision} cosine delta {delta:.2e} "
+                        f"exceeds {QUANTIZE_MAX_COSINE_DELTA:.0e}")
+        return model, 'fp32'
+    logging.info(f"Embedding model runs in {precision} (cosine delta {delta:.2e})")
+    return quantized, precision
+
+
+_WORD_SPLIT_RE = re.compile(r'\W+')
+
+# Query words too common to rank chunks by
+_STOPWORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'do', 'does', 'for', 'from', 'how',
+    'in', 'is', 'it', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was', 'what',
+    'when', 'where', 'which', 'who', 'why', 'with',
+))
+
+
+def _tokenize(text: str) -> List[str]:
+    """Lowercased words of a text, as indexed and queried by keyword search."""
+    return [token for token in _WORD_SPLIT_RE.split(text.lower()) if token]
+
+
+def _top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """
+    Indices of the top_k scores, best first and ties in index order, without
+    sorting every score: a linear-time partition finds the k-th best, and only
+    the scores above it are sorted.
+    """
+    if top_k >= len(scores):
+        return np.argsort(-scores, kind='stable')
+    if top_k <= 0:
+        return np.empty(0, dtype=np.intp)
+    kth = np.partition(scores, len(scores) - top_k)[len(scores) - top_k]
+    above = np.flatnonzero(scores > kth)
+    above = above[np.argsort(-scores[above], kind='stable')]
+    tied = np.flatnonzero(scores == kth)[:top_k - len(above)]
+    return np.concatenate((above, tied))
+
+
+class PageList:
+    """
+    The page texts of an agent's documents, each stored once, with the page's
+    document (an id into doc_names) and page number. Chunks refer to pages by index.
+    """
+
+    def __init__(self):
+        self.doc_names: List[str] = []
+        self.texts: List[str] = []
+        self.doc_ids: List[int] = []
+        self.page_numbers: List[int] = []
+
+    def append(self, text: str, doc_id: int, page_number: int) -> int:
+        """Add a page and return its page id."""
+        self.texts.append(text)
+        self.doc_ids.append(doc_id)
+        self.page_numbers.append(page_number)
+        return len(self.texts) - 1
+
+
+class ChunkList:
+    """
+    Overlapping fixed-size chunks of the pages in a PageList, stored as offsets
+    rather than strings: each chunk is (page id, chunk index), in int32 arrays, and
+    starts at chunk_index * (chunk_size - overlap) in its page. Texts are sliced out
+    of the page on demand, and indexing builds a ChunkData only for search hits.
+    """
+
+    def __init__(self, pages: PageList, chunk_size: int, overlap: int):
+        self.pages = pages
+        self.chunk_size = chunk_size
+        self.stride = chunk_size - overlap
+        self._columns = ([], [])  # page ids, chunk indices while building
+        self.page_ids = self.chunk_indices = np.empty(0, dtype=np.int32)
+
+    def add_page(self, page_id: int):
+        """
+        Add the chunks covering a page, numbered from 0 within the page. Pages must be
+        added in ascending page-id order, so page_ids stays sorted (RetrievalEngine's
+        small-to-large mapping binary-searches it).
+        """
+        page_ids, chunk_indices = self._columns
+        count = len(range(0, len(self.pages.texts[page_id]), self.stride))
+        page_ids.extend([page_id] * count)
+        chunk_indices.extend(range(count))
+
+    def freeze(self):
+        """Pack the columns into arrays once every page has been added."""
+        self.page_ids, self.chunk_indices = (np.array(column, dtype=np.int32) for column in self._columns)
+        self._columns = None
+
+    def text(self, idx: int) -> str:
+        start = int(self.chunk_indices[idx]) * self.stride
+        return self.pages.texts[self.page_ids[idx]][start:start + self.chunk_size]
+
+    @property
+    def texts(self) -> List[str]:
+        """Every chunk's text, materialized (for encoding or indexing)."""
+        return [self.text(idx) for idx in range(len(self))]
+
+    def __len__(self) -> int:
+        return len(self.page_ids) if self._columns is None else len(self._columns[0])
+
+    def __getitem__(self, idx: int) -> ChunkData:
+        page_id = self.page_ids[idx]
+        return ChunkData(self.text(idx), self.pages.doc_names[self.pages.doc_ids[page_id]],
+                         self.pages.page_numbers[page_id], int(self.chunk_indices[idx]))
+
+
+_embedding_model: Optional[SentenceTransformer] = None
+_embedding_model_precision = 'fp32'  # what the shared model actually runs at
+_embedding_model_lock = threading.Lock()
+
+
+def load_embedding_model() -> SentenceTransformer:
+    """
+    Load the embedding model once per process; every engine shares it. The lock
+    makes concurrent first callers (e.g. a preload and a chat turn) wait for one
+    load instead of each loading their own copy of the weights.
+    """
+    global _embedding_model, _embedding_model_precision
+    with _embedding_model_lock:
+        if _embedding_model is None:
+            model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+            model.eval()
+            if EMBEDDING_QUANTIZE:
+                model, _embedding_model_precision = _quantize_model(model)
+            _embedding_model = model
+        return _embedding_model
+
 
 class RetrievalEngine:
     """
@@ -48,172 +276,429 @@ class RetrievalEngine:
     - keyword_search() on small chunks
     """
 
-    def __init__(self, agent_processed_dir: str):
+    def __init__(self, agent_processed_dir: str, model: Optional[SentenceTransformer] = None):
         """
         agent_processed_dir: path to the 'processed' folder for that agent,
                              containing .json files of extracted PDF data.
+        model: embedding model to use; defaults to the process-wide shared one.
         """
         self.agent_processed_dir = agent_processed_dir
-        self.model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+        self.model = model if model is not None else load_embedding_model()
 
-        self.large_chunks: List[ChunkData] = []
-        self.small_chunks: List[ChunkData] = []
+        self.pages = PageList()
+        self.large_chunks = ChunkList(self.pages, LARGE_CHUNK_SIZE, CHUNK_OVERLAP)
+        self.small_chunks = ChunkList(self.pages, SMALL_CHUNK_SIZE, CHUNK_OVERLAP)
         self.large_embeddings = None
+        self.large_index = None  # Faiss index over the large chunks, when HAS_FAISS
+        # Signature of the processed files read; embeddings are only cached for the shared model
+        self._source_signature = None
+        self._use_embedding_cache = model is None
 
         # Build up chunk lists from processed JSON
         self._build_large_and_small_chunks()
+        self.large_chunks.freeze()
+        self.small_chunks.freeze()
+        if self.small_chunks:
+            self._build_keyword_index()
+        # The large chunk each small chunk starts in: small chunks inherit its semantic rank
+        self.small_to_large = self._map_small_to_large()
 
         # Precompute embeddings for large chunks
         if self.large_chunks:
-            texts = [chunk.text for chunk in self.large_chunks]
-            self.large_embeddings = self.model.encode(texts, convert_to_tensor=True)
+            embeddings = self._large_chunk_embeddings()
+            if HAS_FAISS:
+                self.large_index = self._build_index(np.ascontiguousarray(embeddings, dtype=np.float32))
+            elif self.model.device.type == 'cuda':
+                # FP16 on the GPU, where the model runs in half precision
+                self.large_embeddings = torch.from_numpy(np.array(embeddings, dtype=np.float32)).to(
+                    self.model.device, dtype=torch.float16)
+            else:
+                # On CPU a float32 array (possibly the cache's mmap) scored with BLAS
+                self.large_embeddings = embeddings
+
+    def _large_chunk_embeddings(self) -> np.ndarray:
+        """
+        Normalized embeddings of the large chunks: memory-mapped from the agent's
+        embedding cache when it matches the processed files, else encoded (and cached).
+        """
+        cache_path = None
+        if self._use_embedding_cache and self._source_signature:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(self.agent_processed_dir)),
+                                     EMBEDDING_CACHE_DIRNAME)
+            cache_path = os.path.join(cache_dir, f"{self._source_signature}.npy")
+            try:
+                embeddings = np.load(cache_path, mmap_mode='r')
+                if embeddings.shape[0] == len(self.large_chunks):
+                    return embeddings
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                logging.warning(f"Ignoring unreadable embedding cache {cache_path}: {e}")
+
+        embeddings = self.model.encode(self.large_chunks.texts, batch_size=EMBEDDING_BATCH_SIZE,
+                                       convert_to_numpy=True, normalize_embeddings=True,
+                                       show_progress_bar=False)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if cache_path is not None:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                with atomic_writer(cache_path) as f:
+                    np.save(f, embeddings)
+                # Only the current signature is ever read again
+                with os.scandir(cache_dir) as it:
+                    stale = [entry.path for entry in it
+                             if entry.name.endswith('.npy') and entry.path != cache_path]
+                for path in stale:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            except OSError as e:
+                logging.warning(f"Could not write embedding cache {cache_path}: {e}")
+        return embeddings
+
+    @staticmethod
+    def _build_index(embeddings: np.ndarray):
+        """Faiss inner-product index over normalized embeddings (i.e. cosine similarity)."""
+        count, dim = embeddings.shape
+        if count < IVF_MIN_CHUNKS:
+            index = faiss.IndexFlatIP(dim)
+        else:
+            quantizer = faiss.IndexFlatIP(dim)
+            nlist = int(math.sqrt(count))
+            if count >= IVFPQ_MIN_CHUNKS and dim % PQ_SUBVECTORS == 0:
+                index = faiss.IndexIVFPQ(quantizer, dim, nlist, PQ_SUBVECTORS, 8,
+                                         faiss.METRIC_INNER_PRODUCT)
+            else:
+                index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            if count > IVF_TRAIN_SAMPLE:
+                sample = np.random.default_rng(0).choice(count, IVF_TRAIN_SAMPLE, replace=False)
+                index.train(embeddings[sample])
+            else:
+                index.train(embeddings)
+            index.nprobe = IVF_NPROBE
+        index.add(embeddings)
+        return index
 
     def _build_large_and_small_chunks(self):
         """
         Reads each processed .json in the agent's processed dir, extracts page text,
         and splits into large & small overlapping chunks.
         """
-        if not os.path.isdir(self.agent_processed_dir):
+        # One directory read; DirEntry carries the joined path already
+        try:
+            with os.scandir(self.agent_processed_dir) as it:
+                processed_entries = [entry for entry in it
+                                     if entry.name[-5:].lower() == '.json']
+        except (FileNotFoundError, NotADirectoryError):
             return
 
-        processed_files = [f for f in os.listdir(self.agent_processed_dir)
-                           if f.lower().endswith('.json')]
-
-        for proc_file in processed_files:
-            proc_path = os.path.join(self.agent_processed_dir, proc_file)
-            try:
-                with open(proc_path, 'r', encoding='utf-8') as f:
-                    doc = json.load(f)
-            except Exception as e:
-                logging.error(f"Could not read {proc_path}: {e}")
+        # Everything the large-chunk embeddings depend on, in reading order: the model and the
+        # device/precision it runs at (FP16 GPU and int8 CPU vectors differ slightly), then the files
+        device = self.model.device.type
+        signature = hashlib.blake2b(digest_size=16)
+        signature.update(f"{EMBEDDING_MODEL_NAME}|{device}|{_embedding_model_precision}|"
+                         f"{LARGE_CHUNK_SIZE}|{CHUNK_OVERLAP}\n".encode())
+        try:
+            for entry in processed_entries:
+                stat = entry.stat()
+                signature.update(f"{entry.name}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+            self._source_signature = signature.hexdigest()
+        except OSError:
+            pass  # a file vanished mid-scan: build without the cache
+
+        # Documents are read in parallel, then added in directory order
+        paths = [entry.path for entry in processed_entries]
+        if len(paths) > 1:
+            with ThreadPoolExecutor(max_workers=min(INGEST_WORKERS, len(paths)),
+                                    thread_name_prefix='chunk-ingest') as pool:
+                documents = list(pool.map(self._load_pages, paths))
+        else:
+            documents = [self._load_pages(path) for path in paths]
+
+        for entry, pages in zip(processed_entries, documents):
+            if pages is None:
                 continue
+            doc_id = len(self.pages.doc_names)
+            self.pages.doc_names.append(entry.name)
+            for page_num, page_text in pages:
+                # Each page's chunks go in as soon as it gets its (ascending) id, which
+                # keeps both chunk lists sorted by page id
+                page_id = self.pages.append(page_text, doc_id, page_num)
+                # 1) Large chunks for semantic search, 2) small chunks for keyword search
+                self.large_chunks.add_page(page_id)
+                self.small_chunks.add_page(page_id)
+
+    @staticmethod
+    def _load_pages(proc_path: str) -> Optional[List[Tuple[int, str]]]:
+        """
+        Read one processed .json and return its [(page_number, page_text), ...],
+        or None if it can't be read.
+        """
+        try:
+            doc = read_json(proc_path)
+        except Exception as e:
+            logging.error(f"Could not read {proc_path}: {e}")
+            return None
+
+        # doc should have 'content': [ { page_number, text, tables }, ... ]
+        return [(page_data.get('page_number', -1), page_data.get('text', ""))
+                for page_data in doc.get('content', [])]
 
-            # doc should have 'content': [ { page_number, text, tables }, ... ]
-            content_list = doc.get('content', [])
-            for page_data in content_list:
-                page_num = page_data.get('page_number', -1)
-                page_text = page_data.get('text', "")
-
-                # 1) Large chunks for semantic search
-                large_page_chunks = self._split_text_into_chunks(
-                    page_text, chunk_size=LARGE_CHUNK_SIZE, overlap=CHUNK_OVERLAP
-                )
-                for idx, chunk_text in enumerate(large_page_chunks):
-                    chunk = ChunkData(chunk_text, proc_file, page_num, idx)
-                    self.large_chunks.append(chunk)
-
-                # 2) Small chunks for keyword search
-                small_page_chunks = self._split_text_into_chunks(
-                    page_text, chunk_size=SMALL_CHUNK_SIZE, overlap=CHUNK_OVERLAP
-                )
-                for idx, chunk_text in enumerate(small_page_chunks):
-                    chunk = ChunkData(chunk_text, proc_file, page_num, idx)
-                    self.small_chunks.append(chunk)
-
-    def _split_text_into_chunks(self, text: str, chunk_size: int, overlap: int) -> List[str]:
-        """
-        Simple character-based chunking with overlap. 
-        """
-        chunks = []
-        start = 0
-        while start < len(text):
-            end = start + chunk_size
-            chunk_text = text[start:end]
-            chunks.append(chunk_text)
-            start += (chunk_size - overlap)
-        return chunks
+    def _map_small_to_large(self) -> np.ndarray:
+        """For each small chunk, the index of the large chunk containing its start."""
+        large, small = self.large_chunks, self.small_chunks
+        # Chunks are added page by page, so each page's large chunks are one ascending run
+        first_large = np.searchsorted(large.page_ids, small.page_ids)
+        return first_large + small.chunk_indices * small.stride // large.stride
+
+    def _build_keyword_index(self):
+        """
+        BM25 index over the small chunks: a sparse (chunk x term) matrix of precomputed
+        BM25 weights, stored by column so each term's postings are contiguous.
+        """
+        vocab = {}
+        term_ids, chunk_ids, term_freqs = [], [], []
+        lengths = np.zeros(len(self.small_chunks), dtype=np.float32)
+        for i, text in enumerate(self.small_chunks.texts):
+            tokens = _tokenize(text)
+            lengths[i] = len(tokens)
+            for term, freq in Counter(tokens).items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                chunk_ids.append(i)
+                term_freqs.append(freq)
+
+        term_ids = np.array(term_ids, dtype=np.int64)
+        chunk_ids = np.array(chunk_ids, dtype=np.int64)
+        term_freqs = np.array(term_freqs, dtype=np.float32)
+        doc_freqs = np.bincount(term_ids, minlength=len(vocab))
+        idf = np.log1p((len(self.small_chunks) - doc_freqs + 0.5) / (doc_freqs + 0.5))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[chunk_ids] / max(lengths.mean(), 1.0))
+        weights = idf[term_ids] * term_freqs * (BM25_K1 + 1) / (term_freqs + norm)
+
+        self._kw_vocab = vocab
+        self._kw_matrix = sparse.csc_matrix((weights.astype(np.float32), (chunk_ids, term_ids)),
+                                            shape=(len(self.small_chunks), len(vocab)))
 
     def semantic_search(self, query: str, top_k: int = TOP_K_SEMANTIC) -> List[ChunkData]:
         """
         Return the top_k large chunks by embedding cosine similarity to the query.
         """
-        if not self.large_chunks or self.large_embeddings is None:
-            return []
-
-        query_emb = self.model.encode(query, convert_to_tensor=True)
-        scores = util.pytorch_cos_sim(query_emb, self.large_embeddings)[0]
-        top_results = scores.topk(k=min(top_k, len(scores)), largest=True)
+        return self.semantic_search_batch([query], top_k)[0]
 
-        top_indices = top_results[1].cpu().numpy().tolist()
-        result = []
-        for idx in top_indices:
-            result.append(self.large_chunks[idx])
-        return result
+    def semantic_search_batch(self, queries: List[str], top_k: int = TOP_K_SEMANTIC) -> List[List[ChunkData]]:
+        """
+        semantic_search() for several queries at once: one encode() batch and one
+        similarity matrix, instead of a model forward pass per query.
+        """
+        return [[self.large_chunks[idx] for idx in ranking]
+                for ranking in self._semantic_rankings(queries, top_k)]
 
-    def keyword_search(self, query: str, top_k: int = TOP_K_KEYWORD) -> List[ChunkData]:
+    def _semantic_rankings(self, queries: List[str], top_k: int) -> List[List[int]]:
+        """Indices of each query's top_k large chunks, nearest first."""
+        if not queries:
+            return []
+        if self.large_index is not None:
+            query_embs = self.model.encode(queries, batch_size=len(queries), convert_to_numpy=True,
+                                           normalize_embeddings=True)
+            _, top_indices = self.large_index.search(np.ascontiguousarray(query_embs, dtype=np.float32),
+                                                     min(top_k, self.large_index.ntotal))
+            # IVF search pads with -1 when the probed lists hold fewer than top_k vectors
+            return [[idx for idx in row if idx >= 0] for row in top_indices.tolist()]
+        if not self.large_chunks or self.large_embeddings is None:
+            return [[] for _ in queries]
+
+        # Both sides are normalized, so cosine similarity is a single matmul
+        if isinstance(self.large_embeddings, np.ndarray):
+            query_embs = self.model.encode(queries, batch_size=len(queries), convert_to_numpy=True,
+                                           normalize_embeddings=True)
+            scores = np.asarray(query_embs, dtype=np.float32) @ self.large_embeddings.T
+            return [_top_k_indices(row, top_k).tolist() for row in scores]
+
+        query_embs = self.model.encode(queries, batch_size=len(queries), convert_to_tensor=True,
+                                       normalize_embeddings=True)
+        scores = query_embs.to(self.large_embeddings.dtype) @ self.large_embeddings.T
+        top_results = scores.topk(k=min(top_k, scores.shape[1]), dim=1, largest=True)
+        return top_results[1].cpu().numpy().tolist()
+
+    def hybrid_search(
+        self,
+        queries: List[str],
+        keyword_query: str,
+        semantic_top_k: int = TOP_K_SEMANTIC,
+        keyword_top_k: int = TOP_K_KEYWORD
+    ) -> Tuple[List[List[ChunkData]], List[ChunkData]]:
         """
-        Naive approach: Count how many keywords from the query appear in each small chunk.
-        Return the top_k with the highest matches.
+        semantic_search_batch(queries) and a keyword search for keyword_query from a
+        single encode() batch, with the keyword results reranked by fusing their BM25
+        rank with the semantic rank of the large chunk each small chunk lies in.
         """
-        if not self.small_chunks:
+        all_queries = queries if keyword_query in queries else queries + [keyword_query]
+        rankings = self._semantic_rankings(all_queries, max(semantic_top_k, HYBRID_DEPTH))
+        semantic = [[self.large_chunks[idx] for idx in ranking[:semantic_top_k]]
+                    for ranking in rankings[:len(queries)]]
+        return semantic, self.keyword_search(keyword_query, keyword_top_k,
+                                             rankings[all_queries.index(keyword_query)])
+
+    def keyword_search(
+        self,
+        query: str,
+        top_k: int = TOP_K_KEYWORD,
+        semantic_ranking: Optional[List[int]] = None
+    ) -> List[ChunkData]:
+        """
+        Rank the small chunks by BM25 score for the query's distinct non-stopword words
+        and return the top_k (ties, including chunks that match no word, keep document
+        order). A query with no such words returns nothing.
+        With a semantic_ranking of large chunks (nearest first) for the same query, the
+        BM25 ranking is fused with it by Reciprocal Rank Fusion instead, so a query with
+        no such words is ranked by the semantic side alone.
+        """
+        keywords = set(_tokenize(query)) - _STOPWORDS
+        if not self.small_chunks or (not keywords and semantic_ranking is None):
             return []
 
-        query_lower = query.lower()
-        keywords = re.split(r'\W+', query_lower)
-        keywords = [k for k in keywords if k]  # remove empty entries
+        columns = sorted(self._kw_vocab[kw] for kw in keywords if kw in self._kw_vocab)
+        if columns:
+            # One sparse mat-vec over just the query's columns
+            scores = self._kw_matrix[:, columns] @ np.ones(len(columns), dtype=np.float32)
+        else:
+            scores = np.zeros(len(self.small_chunks), dtype=np.float32)
 
-        chunk_scores = []
-        for i, chunk in enumerate(self.small_chunks):
-            text_lower = chunk.text.lower()
-            score = 0
-            for kw in keywords:
-                if kw in text_lower:
-                    score += 1
-            chunk_scores.append((score, i))
+        if semantic_ranking is not None:
+            bm25_ranking = _top_k_indices(scores, HYBRID_DEPTH)
+            bm25_ranking = bm25_ranking[scores[bm25_ranking] > 0]
+            large_weights = np.zeros(len(self.large_chunks), dtype=np.float32)
+            large_weights[semantic_ranking] = 1.0 / (RRF_K + np.arange(1, len(semantic_ranking) + 1))
+            scores = large_weights[self.small_to_large]
+            scores[bm25_ranking] += 1.0 / (RRF_K + np.arange(1, len(bm25_ranking) + 1))
 
-        chunk_scores.sort(key=lambda x: x[0], reverse=True)
-        top_hits = chunk_scores[: min(top_k, len(chunk_scores))]
-        result = []
-        for (score, idx) in top_hits:
-            result.append(self.small_chunks[idx])
+        return [self.small_chunks[idx] for idx in _top_k_indices(scores, top_k).tolist()]
 
-        return result
 
+# agent_processed_dir -> (folder mtime_ns, RetrievalEngine), least recently used first
+_engine_cache = {}
+_engine_cache_lock = threading.Lock()
 
-def save_retrieval_results(
+
+def get_retrieval_engine(agent_processed_dir: str) -> RetrievalEngine:
+    """
+    Return the RetrievalEngine for an agent's processed/ folder, building it only
+    when the folder has changed since the cached one was built. Processed files
+    are swapped in with os.replace(), so every change bumps the folder's mtime.
+    """
+    stamp = os.stat(agent_processed_dir).st_mtime_ns
+    with _engine_cache_lock:
+        cached = _engine_cache.pop(agent_processed_dir, None)
+        if cached is not None and cached[0] == stamp:
+            _engine_cache[agent_processed_dir] = cached
+            return cached[1]
+
+    # Build outside the lock: it reads every document and embeds every chunk
+    engine = RetrievalEngine(agent_processed_dir)
+    with _engine_cache_lock:
+        _engine_cache[agent_processed_dir] = (stamp, engine)
+        while len(_engine_cache) > ENGINE_CACHE_SIZE:
+            del _engine_cache[next(iter(_engine_cache))]
+    return engine
+
+
+def _ensure_retrieval_log(retrieval_file: str):
+    """
+    Convert a pre-JSON-Lines retrieval_results.json next to `retrieval_file`, if
+    there is one and the log doesn't exist yet. Caller holds locked(retrieval_file).
+    """
+    if os.path.exists(retrieval_file):
+        return
+    legacy_path = os.path.splitext(retrieval_file)[0] + '.json'
+    try:
+        legacy_data = read_json(legacy_path)
+    except FileNotFoundError:
+        return
+    except ValueError as e:  # JSONDecodeError / UnicodeDecodeError
+        # Keep the unreadable file for inspection instead of deleting the history
+        logging.error(f"Could not load retrieval_results.json, keeping it as .corrupt: {e}")
+        os.replace(legacy_path, legacy_path + '.corrupt')
+        legacy_data = {}
+    write_json_lines(retrieval_file, [
+        {"conversation_id": conversation_id, "query": query, **entry}
+        for conversation_id, queries in legacy_data.items()
+        for query, entry in queries.items()
+    ])
+    try:
+        os.remove(legacy_path)
+    except FileNotFoundError:  # already set aside as .corrupt
+        pass
+
+
+def save_retrieval_results_bulk(
     data_dir: str,
     username: str,
     agent_name: str,
     conversation_id: str,
-    query: str,
-    semantic_chunks: List[ChunkData],
-    keyword_chunks: List[ChunkData]
+    results: Dict[str, Tuple[List[ChunkData], List[ChunkData]]]
 ):
     """
-    Saves retrieval results to retrieval_results.json under the agent's folder.
+    Saves the retrieval results of several queries ({query: (semantic_chunks, keyword_chunks)})
+    by appending one record per query to the agent's retrieval_results.jsonl:
+    O(records) no matter how much history the file holds.
     """
-    agent_dir = os.path.join(data_dir, username, 'AGENTS', agent_name)
-    retrieval_file = os.path.join(agent_dir, 'retrieval_results.json')
+    retrieval_file = os.path.join(data_dir, username, 'AGENTS', agent_name, 'retrieval_results.jsonl')
+
+    records = [
+        {
+            "conversation_id": conversation_id,
+            "query": query,
+            "semantic_chunks": [ch.to_dict() for ch in semantic_chunks],
+            "keyword_chunks": [ch.to_dict() for ch in keyword_chunks]
+        }
+        for query, (semantic_chunks, keyword_chunks) in results.items()
+    ]
 
-    # Load or create
-    if os.path.exists(retrieval_file):
-        try:
-            with open(retrieval_file, 'r', encoding='utf-8') as f:
-                retrieval_data = json.load(f)
-        except Exception as e:
-            logging.error(f"Could not load retrieval_results.json: {e}")
-            retrieval_data = {}
-    else:
-        retrieval_data = {}
+    # Shares the lock with load_retrieval_results' conversion and compaction
+    with locked(retrieval_file):
+        _ensure_retrieval_log(retrieval_file)
+        append_json_lines(retrieval_file, records)
 
-    if conversation_id not in retrieval_data:
-        retrieval_data[conversation_id] = {}
 
-    def chunk_to_dict(ch: ChunkData) -> dict:
-        return {
-            "text": ch.text,
-            "doc_filename": ch.doc_filename,
-            "page_number": ch.page_number,
-            "chunk_index": ch.chunk_index
-        }
+def load_retrieval_results(retrieval_file: str) -> Dict[str, Dict[str, dict]]:
+    """
+    Fold retrieval_results.jsonl into {conversation_id: {query: {"semantic_chunks", "keyword_chunks"}}};
+    a later record for the same query wins. Rewrites the log without superseded records
+    once they make up most of it. Raises FileNotFoundError if nothing was saved yet.
+    """
+    with locked(retrieval_file):
+        _ensure_retrieval_log(retrieval_file)
+        records = read_json_lines(retrieval_file)
 
-    semantic_list = [chunk_to_dict(ch) for ch in semantic_chunks]
-    keyword_list = [chunk_to_dict(ch) for ch in keyword_chunks]
+        retrieval_data = {}
+        for record in records:
+            retrieval_data.setdefault(record["conversation_id"], {})[record["query"]] = {
+                "semantic_chunks": record.get("semantic_chunks", []),
+                "keyword_chunks": record.get("keyword_chunks", [])
+            }
+
+        live = sum(len(queries) for queries in retrieval_data.values())
+        if len(records) > max(RETRIEVAL_COMPACT_MIN_LINES, 2 * live):
+            write_json_lines(retrieval_file, [
+                {"conversation_id": conversation_id, "query": query, **entry}
+                for conversation_id, queries in retrieval_data.items()
+                for query, entry in queries.items()
+            ])
+    return retrieval_data
 
-    retrieval_data[conversation_id][query] = {
-        "semantic_chunks": semantic_list,
-        "keyword_chunks": keyword_list
-    }
 
-    with open(retrieval_file, 'w', encoding='utf-8') as f:
-        json.dump(retrieval_data, f, indent=2)
\ No newline at end of file
+def save_retrieval_results(
+    data_dir: str,
+    username: str,
+    agent_name: str,
+    conversation_id: str,
+    query: str,
+    semantic_chunks: List[ChunkData],
+    keyword_chunks: List[ChunkData]
+):
+    """
+    Saves retrieval results to retrieval_results.jsonl under the agent's folder.
+    """
+    save_retrieval_results_bulk(data_dir, username, agent_name, conversation_id,
+                                {query: (semantic_chunks, keyword_chunks)})
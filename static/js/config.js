@@ -26,6 +26,7 @@
     // For tracking the current agent's status
     let currentAgentName = null;
     let processingStatusInterval = null;
+    let processingStatusSource = null;
     let processingComplete = false;
     let processingSuccessMessage = null;
 
@@ -310,17 +311,26 @@
         processingComplete = false;
         resetSubmitButtonState('Processing Files...', true); // Button state during processing
 
-        // Check immediately
-        checkProcessingStatus();
+        stopProcessingStatusMonitor();
 
-        // Set up interval to check every 2 seconds
-        processingStatusInterval = setInterval(checkProcessingStatus, 2000);
+        // Prefer server-pushed updates; fall back to polling every 2 seconds
+        if (window.EventSource) {
+            processingStatusSource = new EventSource(`/api/agents/${agentName}/processing-status/stream`);
+            processingStatusSource.onmessage = event => handleProcessingStatus(JSON.parse(event.data));
+        } else {
+            checkProcessingStatus();
+            processingStatusInterval = setInterval(checkProcessingStatus, 2000);
+        }
     }
 
     /**
      * Stop monitoring processing status
      */
     function stopProcessingStatusMonitor() {
+        if (processingStatusSource) {
+            processingStatusSource.close();
+            processingStatusSource = null;
+        }
         if (processingStatusInterval) {
             clearInterval(processingStatusInterval);
             processingStatusInterval = null;
@@ -340,34 +350,39 @@
                 }
                 return response.json();
             })
-            .then(data => {
-                // Update processing status in the UI
-                if (data.file_status) {
-                    Object.entries(data.file_status).forEach(([filename, status]) => {
-                        updateFileStatus(filename, status.status, status.message);
-                    });
-                }
+            .then(handleProcessingStatus)
+            .catch(error => {
+                console.error('Error checking processing status:', error);
+            });
+    }
 
-                // Check if processing is complete
-                if (data.processing_complete && !processingComplete) {
-                    processingComplete = true;
+    /**
+     * Apply a processing status snapshot to the UI
+     */
+    function handleProcessingStatus(data) {
+        // Update processing status in the UI
+        if (data.file_status) {
+            Object.entries(data.file_status).forEach(([filename, status]) => {
+                updateFileStatus(filename, status.status, status.message);
+            });
+        }
 
-                    // Update UI to reflect completion
-                    resetSubmitButtonState('Confirm Agent Creation'); // Button state after processing complete
+        // Check if processing is complete
+        if (data.processing_complete && !processingComplete) {
+            processingComplete = true;
 
-                    // Remove any existing message
-                    removeProcessingCompleteMessage();
+            // Update UI to reflect completion
+            resetSubmitButtonState('Confirm Agent Creation'); // Button state after processing complete
 
-                    // Show a success message above the button
-                    showProcessingCompleteMessage(data.files_processed);
+            // Remove any existing message
+            removeProcessingCompleteMessage();
 
-                    // Stop monitoring
-                    stopProcessingStatusMonitor();
-                }
-            })
-            .catch(error => {
-                console.error('Error checking processing status:', error);
-            });
+            // Show a success message above the button
+            showProcessingCompleteMessage(data.files_processed);
+
+            // Stop monitoring
+            stopProcessingStatusMonitor();
+        }
     }
 
     /**
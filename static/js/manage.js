@@ -28,6 +28,7 @@
 
     // Processing status monitoring
     let statusInterval = null;
+    let statusSource = null;
     let filesCurrentlyProcessing = false; // Flag to track if any files are processing
     let processingSuccessMessage = null;
     let justFinishedProcessing = false; // Flag to track if processing just finished
@@ -112,17 +113,26 @@
      * Start monitoring processing status
      */
     function startProcessingStatusMonitor() {
-        // Check immediately
-        checkProcessingStatus();
+        stopProcessingStatusMonitor();
 
-        // Set up interval to check every 2 seconds for better responsiveness
-        statusInterval = setInterval(checkProcessingStatus, 2000);
+        // Prefer server-pushed updates; fall back to polling every 2 seconds
+        if (window.EventSource) {
+            statusSource = new EventSource(`/api/agents/${originalAgentName}/processing-status/stream`);
+            statusSource.onmessage = event => handleProcessingStatus(JSON.parse(event.data));
+        } else {
+            checkProcessingStatus();
+            statusInterval = setInterval(checkProcessingStatus, 2000);
+        }
     }
 
     /**
      * Stop monitoring processing status
      */
     function stopProcessingStatusMonitor() {
+        if (statusSource) {
+            statusSource.close();
+            statusSource = null;
+        }
         if (statusInterval) {
             clearInterval(statusInterval);
             statusInterval = null;
@@ -143,97 +153,102 @@
                 }
                 return response.json();
             })
-            .then(data => {
-                // Update processing status in the UI
-                if (data.file_status) {
-                    let allFilesSuccessful = true;
-                    let anyProcessing = false;
-
-                    for (const [filename, status] of Object.entries(data.file_status)) {
-                        // Update UI to show current status
-                        updateFileStatus(filename, status.status, status.message);
-
-                        // Check if any file has an error status
-                        if (status.status === 'error') {
-                            allFilesSuccessful = false;
-                        }
+            .then(handleProcessingStatus)
+            .catch(error => {
+                console.error('Error checking processing status:', error);
+            });
+    }
 
-                        // Check if any file is still processing
-                        if (status.status === 'processing' || status.status === 'pending') {
-                            anyProcessing = true;
-                        }
-                    }
+    /**
+     * Apply a processing status snapshot to the UI
+     */
+    function handleProcessingStatus(data) {
+        // Update processing status in the UI
+        if (data.file_status) {
+            let allFilesSuccessful = true;
+            let anyProcessing = false;
+
+            for (const [filename, status] of Object.entries(data.file_status)) {
+                // Update UI to show current status
+                updateFileStatus(filename, status.status, status.message);
+
+                // Check if any file has an error status
+                if (status.status === 'error') {
+                    allFilesSuccessful = false;
+                }
 
-                    // Update processing flag
-                    const wasProcessing = filesCurrentlyProcessing;
-                    filesCurrentlyProcessing = anyProcessing;
-
-                    // If files were processing and now they're done
-                    if (wasProcessing && !anyProcessing && data.processing_complete) {
-                        // Make a direct fetch to get the latest file status
-                        fetch(`/api/agents/${originalAgentName}`)
-                            .then(response => response.json())
-                            .then(agentData => {
-                                // Update all file statuses based on latest data
-                                if (agentData.files && agentData.files.length > 0) {
-                                    agentData.files.forEach(file => {
-                                        // Force update status to 'success' for all processed files
-                                        if (file.processed) {
-                                            updateFileStatus(file.name, 'success', 'Processed');
-                                        }
-                                    });
+                // Check if any file is still processing
+                if (status.status === 'processing' || status.status === 'pending') {
+                    anyProcessing = true;
+                }
+            }
+
+            // Update processing flag
+            const wasProcessing = filesCurrentlyProcessing;
+            filesCurrentlyProcessing = anyProcessing;
+
+            // If files were processing and now they're done
+            if (wasProcessing && !anyProcessing && data.processing_complete) {
+                // Make a direct fetch to get the latest file status
+                fetch(`/api/agents/${originalAgentName}`)
+                    .then(response => response.json())
+                    .then(agentData => {
+                        // Update all file statuses based on latest data
+                        if (agentData.files && agentData.files.length > 0) {
+                            agentData.files.forEach(file => {
+                                // Force update status to 'success' for all processed files
+                                if (file.processed) {
+                                    updateFileStatus(file.name, 'success', 'Processed');
                                 }
-                                
-                                // Show completion message
-                                showProcessingCompleteMessage(allFilesSuccessful);
-                                
-                                // Set flag that we just finished processing
-                                justFinishedProcessing = true;
-                                
-                                // Update original files to include the newly processed ones
-                                originalFiles = [...uploadedFiles].map(file => {
-                                    if (file instanceof File) {
-                                        return {
-                                            name: file.name,
-                                            size: file.size,
-                                            type: file.type || 'application/pdf',
-                                            isExisting: true,
-                                            processed: true
-                                        };
-                                    }
-                                    return {...file, processed: true};
-                                });
-                                
-                                // Mark all uploaded files as processed and existing
-                                uploadedFiles = uploadedFiles.map(file => {
-                                    if (file instanceof File) {
-                                        return {
-                                            name: file.name,
-                                            size: file.size,
-                                            type: file.type || 'application/pdf',
-                                            isExisting: true,
-                                            processed: true
-                                        };
-                                    }
-                                    return {...file, processed: true};
-                                });
-                                
-                                // Reset button state to enabled with "Save" text
-                                updateButton.textContent = 'Save';
-                                updateButton.disabled = false;
-                                
-                                // Stop monitoring as processing is complete
-                                stopProcessingStatusMonitor();
-                            })
-                            .catch(error => {
-                                console.error('Error fetching updated agent data:', error);
                             });
-                    }
-                }
-            })
-            .catch(error => {
-                console.error('Error checking processing status:', error);
-            });
+                        }
+
+                        // Show completion message
+                        showProcessingCompleteMessage(allFilesSuccessful);
+
+                        // Set flag that we just finished processing
+                        justFinishedProcessing = true;
+
+                        // Update original files to include the newly processed ones
+                        originalFiles = [...uploadedFiles].map(file => {
+                            if (file instanceof File) {
+                                return {
+                                    name: file.name,
+                                    size: file.size,
+                                    type: file.type || 'application/pdf',
+                                    isExisting: true,
+                                    processed: true
+                                };
+                            }
+                            return {...file, processed: true};
+                        });
+
+                        // Mark all uploaded files as processed and existing
+                        uploadedFiles = uploadedFiles.map(file => {
+                            if (file instanceof File) {
+                                return {
+                                    name: file.name,
+                                    size: file.size,
+                                    type: file.type || 'application/pdf',
+                                    isExisting: true,
+                                    processed: true
+                                };
+                            }
+                            return {...file, processed: true};
+                        });
+
+                        // Reset button state to enabled with "Save" text
+                        updateButton.textContent = 'Save';
+                        updateButton.disabled = false;
+
+                        // Stop monitoring as processing is complete
+                        stopProcessingStatusMonitor();
+                    })
+                    .catch(error => {
+                        console.error('Error fetching updated agent data:', error);
+                    });
+            }
+        }
     }
 
     /**
@@ -0,0 +1,34 @@
+# tests/conftest.py
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py creates DATA_DIR at import, so point it somewhere disposable first
+os.environ.setdefault('ZAPIENT_DATA_DIR', tempfile.mkdtemp(prefix='zapient-tests-'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def app_module():
+    import app
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    """Test client logged in as a fresh user, so every test starts without agents"""
+    client = app_module.app.test_client()
+    with client.session_transaction() as sess:
+        sess['username'] = f"user-{os.urandom(4).hex()}"
+    return client
+
+
+@pytest.fixture
+def agent(client):
+    """Name of an agent created through the API for the logged-in user"""
+    response = client.post('/api/agents', json={"name": "Demo Agent", "persona": "p" * 1000})
+    assert response.status_code == 200
+    return "Demo Agent"
@@ -0,0 +1,264 @@
+# tests/test_app.py
+
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+
+@pytest.mark.parametrize('url', ['/api/agents', '/api/agents/Demo Agent'])
+def test_compressed_json_revalidates_with_etag(app_module, client, agent, url):
+    if not app_module.HAS_COMPRESS:
+        pytest.skip("Flask-Compress not installed")
+    first = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert first.status_code == 200
+    assert first.headers['Content-Encoding'] == 'gzip'
+    etag = first.headers['ETag']
+    assert etag.endswith(':gzip"')
+
+    again = client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert again.status_code == 304
+
+
+def test_uncompressed_json_revalidates_with_etag(client, agent):
+    first = client.get('/api/agents')
+    assert first.status_code == 200
+    again = client.get('/api/agents', headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+
+
+def _upload_path(app_module, client, agent, name):
+    username = client.get('/api/current-user').get_json()['username']
+    return os.path.join(app_module._agent_paths(username, agent).uploads_dir, name)
+
+
+@pytest.mark.parametrize('mode', ['', 'nginx'])
+def test_uploaded_file_cache_policy_is_the_same_in_every_mode(app_module, client, agent, monkeypatch, mode):
+    monkeypatch.setattr(app_module, 'SENDFILE_MODE', mode)
+    with open(_upload_path(app_module, client, agent, 'report.pdf'), 'wb') as f:
+        f.write(b'%PDF-1.4 test')
+
+    response = client.get(f'/api/agents/{agent}/files/report.pdf')
+    assert response.status_code == 200
+    if mode == 'nginx':
+        assert response.headers['X-Accel-Redirect'].endswith('/uploads/report.pdf')
+    assert response.headers['Cache-Control'] == 'private, max-age=3600'
+
+
+def test_status_stream_ends_when_nothing_is_processing(client, agent):
+    response = client.get(f'/api/agents/{agent}/processing-status/stream')
+    assert response.status_code == 200
+    # Reading the whole body only returns because the idle stream closes itself
+    events = response.get_data().split(b'\n\n')
+    assert events[0].startswith(b'retry: ')
+    assert events[1].startswith(b'data: ')
+    assert events[2:] == [b'']
+
+
+def test_login_redirect_honours_script_name(app_module):
+    client = app_module.app.test_client()
+    assert client.get('/dashboard').headers['Location'] == '/login'
+    mounted = client.get('/dashboard', environ_overrides={'SCRIPT_NAME': '/zapient'})
+    assert mounted.headers['Location'] == '/zapient/login'
+
+
+@pytest.fixture
+def files_log(app_module, client, agent, monkeypatch):
+    """(username, files.jsonl path, offsets each read_json_lines call started at)"""
+    username = client.get('/api/current-user').get_json()['username']
+    reads = []
+
+    def recording_read(path, start=0, end=None):
+        reads.append(start)
+        return read_json_lines(path, start, end)
+
+    read_json_lines = app_module.read_json_lines
+    monkeypatch.setattr(app_module, 'read_json_lines', recording_read)
+    return username, app_module._files_log_path(username, agent), reads
+
+
+def test_files_index_folds_only_the_appended_tail(app_module, agent, files_log):
+    username, log_path, reads = files_log
+    app_module.add_files_to_json(username, agent, [{"name": "a.pdf", "status": "queued"}])
+    assert app_module.get_files_index(username, agent) == {"a.pdf": {"name": "a.pdf", "status": "queued"}}
+
+    # Another process (a processing worker) appends behind the cache's back
+    size = os.path.getsize(log_path)
+    app_module.append_json_lines(log_path, [{"name": "a.pdf", "status": "processed"},
+                                            {"name": "b.pdf", "status": "queued"}])
+    reads.clear()
+    assert app_module.get_files_index(username, agent) == {
+        "a.pdf": {"name": "a.pdf", "status": "processed"},
+        "b.pdf": {"name": "b.pdf", "status": "queued"},
+    }
+    assert reads == [size]
+
+
+def test_files_index_applies_an_appended_tombstone(app_module, agent, files_log):
+    username, log_path, reads = files_log
+    app_module.add_files_to_json(username, agent, [{"name": "a.pdf"}, {"name": "b.pdf"}])
+    app_module.get_files_index(username, agent)
+
+    size = os.path.getsize(log_path)
+    app_module.append_json_lines(log_path, [{"name": "a.pdf", "deleted": True}])
+    reads.clear()
+    assert app_module.get_files_index(username, agent) == {"b.pdf": {"name": "b.pdf"}}
+    assert reads == [size]
+
+
+@pytest.mark.parametrize('rewrite', ['replace', 'shrink', 'same-size'])
+def test_files_index_rereads_a_rewritten_log(app_module, agent, files_log, rewrite):
+    username, log_path, reads = files_log
+    app_module.add_files_to_json(username, agent, [{"name": "a.pdf"}, {"name": "b.pdf"}])
+    app_module.get_files_index(username, agent)
+
+    # Rewrites by another process whose old size still falls on a line boundary,
+    # so only the stat stamp tells them apart from an append
+    inode = os.stat(log_path).st_ino
+    if rewrite == 'replace':
+        # A new file (as a compaction writes) that is also longer
+        app_module.write_json_lines(log_path, [{"name": "c.pdf"}, {"name": "d.pdf"}, {"name": "e.pdf"}])
+        assert os.stat(log_path).st_ino != inode
+        expected = ["c.pdf", "d.pdf", "e.pdf"]
+    else:
+        with open(log_path, 'r+b') as f:
+            f.truncate(0)
+            f.write(b'{"name":"c.pdf"}\n' + (b'{"name":"d.pdf"}\n' if rewrite == 'same-size' else b''))
+        assert os.stat(log_path).st_ino == inode
+        expected = ["c.pdf", "d.pdf"] if rewrite == 'same-size' else ["c.pdf"]
+    reads.clear()
+    assert list(app_module.get_files_index(username, agent)) == expected
+    assert reads == [0]
+
+
+def _file_writes(prefix, count):
+    """Batches that add, update and (every fifth file) delete files named after prefix"""
+    for i in range(count):
+        name = f"{prefix}-{i}.pdf"
+        yield [{"name": name, "status": "queued"}]
+        yield [{"name": name, "status": "processed", "pages": i}]
+        if i % 5 == 0:
+            yield [{"name": name, "deleted": True}]
+
+
+def _expected_files(prefix, count):
+    return {f"{prefix}-{i}.pdf": {"name": f"{prefix}-{i}.pdf", "status": "processed", "pages": i}
+            for i in range(count) if i % 5}
+
+
+# Appends as a separate worker process would, serialized only by locked()'s flock
+_APPENDER = """
+import sys
+from json_utils import append_json_lines, locked
+log_path, count = sys.argv[1], int(sys.argv[2])
+for i in range(count):
+    name = f"proc-{i}.pdf"
+    batches = [[{"name": name, "status": "queued"}], [{"name": name, "status": "processed", "pages": i}]]
+    if i % 5 == 0:
+        batches.append([{"name": name, "deleted": True}])
+    for batch in batches:
+        with locked(log_path):
+            append_json_lines(log_path, batch)
+"""
+
+
+def test_compaction_racing_appends_loses_no_records(app_module, client, agent):
+    username = client.get('/api/current-user').get_json()['username']
+    log_path = app_module._files_log_path(username, agent)
+    count = 150
+    done = threading.Event()
+
+    def append_from_thread(prefix):
+        for batch in _file_writes(prefix, count):
+            app_module.add_files_to_json(username, agent, batch)
+
+    def compact():
+        while not done.is_set():
+            app_module._compact_files_log(username, agent)
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    appender = subprocess.Popen([sys.executable, '-c', _APPENDER, log_path, str(count)], cwd=repo_root)
+    writers = [threading.Thread(target=append_from_thread, args=(prefix,)) for prefix in ('t1', 't2')]
+    compactor = threading.Thread(target=compact)
+    for thread in writers + [compactor]:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    assert appender.wait(timeout=60) == 0
+    done.set()
+    compactor.join()
+
+    expected = {**_expected_files('t1', count), **_expected_files('t2', count), **_expected_files('proc', count)}
+    folded = app_module._fold_file_records(app_module.read_json_lines(log_path))
+    assert folded == expected
+    assert app_module.get_files_index(username, agent) == expected
+
+    # Compaction leaves one line per live file and the same folded state
+    app_module._compact_files_log(username, agent)
+    assert app_module.read_json_lines(log_path) == list(folded.values())
+    assert app_module.get_files_index(username, agent) == expected
+
+
+def _update_conversation_in_place(chat_history, conversation_id, mutate):
+    """How chat_history.json was updated before the log: mutate the stored conversation"""
+    conversations = chat_history["conversations"]
+    if conversation_id not in conversations:
+        conversations[conversation_id] = {"conversation_id": conversation_id, "messages": []}
+    mutate(conversations[conversation_id])
+
+
+def test_chat_log_folds_to_the_chat_history_json_shape(app_module, client, agent):
+    username = client.get('/api/current-user').get_json()['username']
+    chat_history = {"conversations": {}}
+
+    def user_turn(conversation_id, text):
+        message = {"role": "user", "content": text, "timestamp": "2024-01-01T00:00:00+00:00"}
+        analysis = {"original_query": text, "sub_queries": [text], "keywords": text.split()}
+
+        def add_user_turn(conversation):
+            conversation["messages"].append(message)
+            conversation.setdefault("analysis", []).append(analysis)
+
+        _update_conversation_in_place(chat_history, conversation_id, add_user_turn)
+        app_module._append_chat_records(username, agent, [
+            {"conversation_id": conversation_id, "message": message},
+            {"conversation_id": conversation_id, "analysis": analysis}
+        ])
+
+    def answer(conversation_id, text):
+        message = {"role": "assistant", "content": text, "sources": [{"file": "a.pdf", "page": 1}]}
+        _update_conversation_in_place(chat_history, conversation_id,
+                                      lambda conversation: conversation["messages"].append(message))
+        app_module._append_chat_records(username, agent, [{"conversation_id": conversation_id, "message": message}])
+
+    def assert_same_shape():
+        response = client.get(f'/api/agents/{agent}/chat-history')
+        assert response.get_json() == {"conversations": list(chat_history["conversations"].values())}
+
+    assert_same_shape()
+    user_turn("default", "what is the torque spec")  # a new conversation
+    assert_same_shape()
+    answer("default", "40 Nm")  # an appended message
+    assert_same_shape()
+    user_turn("default", "and for the M8 bolt")  # a second analysis on the same conversation
+    user_turn("other", "who made the pump")
+    answer("default", "25 Nm")
+    assert_same_shape()
+
+
+def test_legacy_chat_history_json_is_converted(app_module, client, agent):
+    username = client.get('/api/current-user').get_json()['username']
+    paths = app_module._agent_paths(username, agent)
+    assert not os.path.exists(paths.chat_log)  # nothing has read or written the chat yet
+    conversations = {
+        "default": {"conversation_id": "default", "messages": [{"role": "user", "content": "hi"}],
+                    "analysis": [{"original_query": "hi"}]},
+        "other": {"conversation_id": "other", "messages": []},
+    }
+    app_module.write_json(os.path.join(paths.agent_dir, 'chat_history.json'), {"conversations": conversations})
+
+    response = client.get(f'/api/agents/{agent}/chat-history')
+    assert response.get_json() == {"conversations": list(conversations.values())}
+    assert not os.path.exists(os.path.join(paths.agent_dir, 'chat_history.json'))
@@ -0,0 +1,75 @@
+# tests/test_file_processor.py
+
+import dataclasses
+
+import pytest
+
+import file_processor
+from json_utils import dumps, read_json
+
+
+METADATA = file_processor.DocumentMetadata(
+    filename='manual.pdf', file_path='manual.pdf', file_hash='0' * 64,
+    extraction_date='2024-01-01T00:00:00', title='Title', author='', subject='', creator='',
+    creation_date='', page_count=0, total_tables=0, pages_with_tables=0)
+
+
+@pytest.mark.parametrize('page_count', [0, 1, 3])
+def test_processed_document_round_trips_through_read_json(tmp_path, monkeypatch, page_count):
+    pages = [{"page_number": n, "text": f"Page \"{n}\"\nwith ünïcode", "tables": []}
+             for n in range(1, page_count + 1)]
+
+    def extract(pdf_path, out):
+        # Streams the pages the way extract_document_content does
+        for page in pages:
+            if page['page_number'] > 1:
+                out.write(b',')
+            out.write(dumps(page))
+        return METADATA, ' '.join(page['text'] for page in pages)
+
+    monkeypatch.setattr(file_processor, 'extract_document_content', extract)
+    pdf_path = tmp_path / 'manual.pdf'
+    pdf_path.write_bytes(b'%PDF-1.4')
+
+    result = file_processor.process_document_full(pdf_path, tmp_path / 'processed', api_key='')
+    assert result['status'] == 'success'
+    document = read_json(result['output_path'])
+    assert list(document) == ["content", "metadata", "advanced_processing_error",
+                              "advanced_metadata", "used_fallback_metadata"]
+    assert document["content"] == pages
+    assert document["metadata"] == dataclasses.asdict(METADATA)
+    assert document["advanced_metadata"]["intent"] == "Technical"
+    assert document["used_fallback_metadata"] is True
+
+
+# (table, cleaned data) pairs, as the DataFrame-based cleaning produced them
+TABLES = [
+    ([["Part", "Qty"], ["Bolt", "4"], ["Nut", "8"]],
+     [["Part", "Qty"], ["Bolt", "4"], ["Nut", "8"]]),
+    # Blank and whitespace-only cells become None; rows and columns left empty go
+    ([["Part", "", "Qty"], ["  ", None, "\n"], ["Bolt", " \t", "4"], [None, "", None]],
+     [["Part", "Qty"], ["Bolt", "4"]]),
+    # Ragged rows are padded; a column that is only padding is dropped
+    ([["A", "B", None], ["C"], [" x ", None, " "]],
+     [["A", "B"], ["C", None], [" x ", None]]),
+    ([[None, " "], ["", None]], []),
+    ([], []),
+]
+
+
+@pytest.mark.parametrize('table, expected', TABLES)
+def test_process_table_cleans_cells(table, expected):
+    result = file_processor.process_table(table, (0, 10, 100, 50), None, 2, 0,
+                                          file_processor.index_page_words([]))
+    assert result['data'] == expected
+    metadata = result['metadata']
+    assert (metadata.rows, metadata.columns) == (len(expected), len(expected[0]) if expected else 0)
+    assert metadata.headers == [f'Column_{i + 1}' for i in range(metadata.columns)]
+
+
+@pytest.mark.parametrize('table, expected', TABLES)
+def test_table_fixtures_match_the_dataframe_cleaning(table, expected):
+    pd = pytest.importorskip('pandas')
+    df = pd.DataFrame(table, dtype=object).replace(r'^\s*$', None, regex=True)
+    df = df.dropna(how='all', axis=1).dropna(how='all', axis=0)
+    assert (df.values.tolist() if not df.empty else []) == expected
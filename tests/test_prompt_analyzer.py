@@ -0,0 +1,46 @@
+# tests/test_prompt_analyzer.py
+
+import pytest
+
+import prompt_analyzer
+
+
+@pytest.fixture
+def gemini_calls(monkeypatch):
+    """Stand in for the Gemini request: records each query and analyzes it by splitting words"""
+    calls = []
+
+    def fake_request(api_key, user_query):
+        calls.append(user_query)
+        return {"original_query": user_query, "sub_queries": [user_query], "keywords": user_query.split()}
+
+    monkeypatch.setattr(prompt_analyzer, 'HAS_GEMINI', True)
+    monkeypatch.setattr(prompt_analyzer, '_request_analysis', fake_request)
+    monkeypatch.setattr(prompt_analyzer, '_analysis_cache', prompt_analyzer.PromptAnalysisCache(16, 3600))
+    return calls
+
+
+def test_near_identical_query_is_analyzed_again(gemini_calls):
+    first = prompt_analyzer.analyze_prompt_with_gemini('key', 'revenue in 2023', cache_scope='alice')
+    second = prompt_analyzer.analyze_prompt_with_gemini('key', 'revenue in 2024', cache_scope='alice')
+
+    assert gemini_calls == ['revenue in 2023', 'revenue in 2024']
+    assert first['keywords'] == ['revenue', 'in', '2023']
+    assert second['sub_queries'] == ['revenue in 2024']
+    assert second['keywords'] == ['revenue', 'in', '2024']
+
+
+def test_same_query_up_to_case_and_whitespace_is_cached(gemini_calls):
+    prompt_analyzer.analyze_prompt_with_gemini('key', 'Revenue in 2023', cache_scope='alice')
+    cached = prompt_analyzer.analyze_prompt_with_gemini('key', '  revenue   IN 2023 ', cache_scope='alice')
+
+    assert gemini_calls == ['Revenue in 2023']
+    assert cached['original_query'] == '  revenue   IN 2023 '
+    assert cached['keywords'] == ['Revenue', 'in', '2023']
+
+
+def test_cache_is_per_scope(gemini_calls):
+    prompt_analyzer.analyze_prompt_with_gemini('key', 'revenue in 2023', cache_scope='alice')
+    prompt_analyzer.analyze_prompt_with_gemini('key', 'revenue in 2023', cache_scope='bob')
+
+    assert len(gemini_calls) == 2
@@ -0,0 +1,219 @@
+# tests/test_retrieval_engine.py
+
+import json
+import math
+import types
+import zlib
+
+import numpy as np
+import pytest
+
+import retrieval_engine
+
+
+class FakeModel:
+    """Deterministic stand-in for the SentenceTransformer: a pseudo-random vector per text"""
+
+    device = types.SimpleNamespace(type='cpu')
+
+    def __init__(self, noise=0.0):
+        self.noise = noise
+
+    def encode(self, texts, convert_to_numpy=True, normalize_embeddings=False, **kwargs):
+        vectors = np.stack([
+            np.random.default_rng(zlib.crc32(text.encode())).standard_normal(32).astype(np.float32)
+            for text in texts
+        ])
+        if self.noise:
+            vectors += self.noise * np.random.default_rng(0).standard_normal(vectors.shape).astype(np.float32)
+        if normalize_embeddings:
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
+
+
+def test_quantized_model_is_used_when_it_matches_fp32(monkeypatch):
+    model, quantized = FakeModel(), FakeModel(noise=1e-4)
+    monkeypatch.setattr(retrieval_engine.torch.quantization, 'quantize_dynamic',
+                        lambda *args, **kwargs: quantized)
+    assert retrieval_engine._quantize_model(model) == (quantized, 'int8')
+
+
+def test_quantization_is_skipped_when_embeddings_drift(monkeypatch):
+    model, quantized = FakeModel(), FakeModel(noise=0.5)
+    monkeypatch.setattr(retrieval_engine.torch.quantization, 'quantize_dynamic',
+                        lambda *args, **kwargs: quantized)
+    assert retrieval_engine._quantize_model(model) == (model, 'fp32')
+
+
+def _engine(tmp_path, documents):
+    """RetrievalEngine over processed JSONs, one per {filename: [page text, ...]} entry"""
+    for name, pages in documents.items():
+        content = [{"page_number": number, "text": text} for number, text in enumerate(pages, 1)]
+        (tmp_path / name).write_text(json.dumps({"content": content}))
+    return retrieval_engine.RetrievalEngine(str(tmp_path), FakeModel())
+
+
+def _pages(chunks):
+    return [chunk.page_number for chunk in chunks]
+
+
+def test_keyword_ranking_is_fused_with_semantic_ranking(tmp_path):
+    # Short pages: one large and one small chunk each, so chunk i is page i + 1
+    engine = _engine(tmp_path, {"doc.json": ["apple banana", "cherry", "banana banana", "durian"]})
+
+    assert _pages(engine.keyword_search("banana")) == [3, 1, 2, 4]
+    # Page 1 is second by both rankings, which beats first by one and last by the other
+    assert _pages(engine.keyword_search("banana", semantic_ranking=[3, 0, 1, 2])) == [1, 3, 4, 2]
+
+
+def test_stopword_only_query_ranks_by_semantic_side(tmp_path):
+    engine = _engine(tmp_path, {"doc.json": ["apple banana", "cherry", "banana banana", "durian"]})
+
+    assert engine.keyword_search("what is this") == []
+    assert _pages(engine.keyword_search("what is this", semantic_ranking=[3, 0, 1, 2])) == [4, 1, 2, 3]
+    semantic, keyword = engine.hybrid_search(["what is this"], "what is this", 4, 4)
+    assert _pages(keyword) == _pages(semantic[0])
+
+
+def test_small_chunks_map_to_the_large_chunk_they_start_in(tmp_path):
+    rng = np.random.default_rng(0)
+    words = ["alpha", "beta", "gamma", "delta", "epsilon"]
+
+    def page(length):
+        return " ".join(rng.choice(words, size=length))[:length]
+
+    engine = _engine(tmp_path, {
+        "a.json": [page(7000), page(120), "", page(2950), page(3000)],
+        "b.json": [page(5800)],
+        "c.json": [page(40), page(9100), page(2951)],
+    })
+
+    large, small = engine.large_chunks, engine.small_chunks
+    assert len(set(large.page_ids.tolist())) == 8  # every page but the empty one
+    large_starts = [(int(page_id), int(chunk_idx) * large.stride)
+                    for page_id, chunk_idx in zip(large.page_ids, large.chunk_indices)]
+    for i, large_idx in enumerate(engine.small_to_large.tolist()):
+        start = (int(small.page_ids[i]), int(small.chunk_indices[i]) * small.stride)
+        # The last large chunk of the same page starting at or before the small chunk...
+        expected = max(j for j, large_start in enumerate(large_starts)
+                       if large_start[0] == start[0] and large_start[1] <= start[1])
+        assert large_idx == expected
+        # ...which therefore contains its start
+        assert start[1] < large_starts[large_idx][1] + large.chunk_size
+
+
+def _reference_bm25(texts, query):
+    """BM25 written out term by term, as in the textbook formula"""
+    docs = [retrieval_engine._tokenize(text) for text in texts]
+    avg_len = max(sum(map(len, docs)) / len(docs), 1.0)
+    k1, b = retrieval_engine.BM25_K1, retrieval_engine.BM25_B
+    scores = []
+    for doc in docs:
+        score = 0.0
+        for term in set(retrieval_engine._tokenize(query)) - retrieval_engine._STOPWORDS:
+            df = sum(term in other for other in docs)
+            tf = doc.count(term)
+            idf = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(doc) / avg_len))
+        scores.append(score)
+    return scores
+
+
+BM25_PAGES = [
+    "the quarterly revenue grew while revenue targets held",
+    "costs fell",
+    "revenue",
+    "a long page about costs, margins, revenue and more costs than revenue",
+    "costs fell",
+    "nothing relevant here",
+    "revenue",
+]
+
+
+@pytest.mark.parametrize('query', ["revenue", "costs fell", "revenue costs margins", "what revenue"])
+def test_keyword_scores_match_reference_bm25(tmp_path, query):
+    engine = _engine(tmp_path, {"doc.json": BM25_PAGES})
+    keywords = set(retrieval_engine._tokenize(query)) - retrieval_engine._STOPWORDS
+    columns = [engine._kw_vocab[term] for term in keywords]
+    scores = np.asarray(engine._kw_matrix[:, columns].sum(axis=1)).ravel()
+    reference = _reference_bm25(BM25_PAGES, query)
+    np.testing.assert_allclose(scores, reference, rtol=1e-5)
+
+    # Best first, ties (equal pages, and every page matching nothing) in document order
+    expected = sorted(range(len(BM25_PAGES)), key=lambda i: -reference[i])
+    assert _pages(engine.keyword_search(query, top_k=len(BM25_PAGES))) == [i + 1 for i in expected]
+    assert _pages(engine.keyword_search(query, top_k=3)) == [i + 1 for i in expected[:3]]
+
+
+def test_keyword_ties_keep_document_order(tmp_path):
+    engine = _engine(tmp_path, {"doc.json": BM25_PAGES})
+    # Pages 2 and 5 tie on "fell" and every other page scores zero; pages 3 and 7 tie on "revenue"
+    assert _pages(engine.keyword_search("fell", top_k=5)) == [2, 5, 1, 3, 4]
+    assert _pages(engine.keyword_search("revenue", top_k=2)) == [3, 7]
+
+
+def _chunk(text):
+    return retrieval_engine.ChunkData(text, "doc.json", 1, 0)
+
+
+def _entry(semantic, keyword):
+    return {"semantic_chunks": [_chunk(text).to_dict() for text in semantic],
+            "keyword_chunks": [_chunk(text).to_dict() for text in keyword]}
+
+
+LEGACY_RESULTS = {
+    "conv-1": {"first question": _entry(["a"], ["b", "c"]), "second question": _entry([], ["d"])},
+    "conv-2": {"first question": _entry(["e"], [])},
+}
+
+
+def test_legacy_retrieval_results_are_converted(tmp_path):
+    (tmp_path / 'retrieval_results.json').write_text(json.dumps(LEGACY_RESULTS))
+    log_path = tmp_path / 'retrieval_results.jsonl'
+
+    assert retrieval_engine.load_retrieval_results(str(log_path)) == LEGACY_RESULTS
+    assert not (tmp_path / 'retrieval_results.json').exists()
+    assert len(log_path.read_text().splitlines()) == 3
+    assert retrieval_engine.load_retrieval_results(str(log_path)) == LEGACY_RESULTS
+
+
+def test_corrupt_legacy_retrieval_results_are_kept_aside(tmp_path):
+    (tmp_path / 'retrieval_results.json').write_text('{"conv-1": {"que')
+    log_path = tmp_path / 'retrieval_results.jsonl'
+
+    assert retrieval_engine.load_retrieval_results(str(log_path)) == {}
+    assert not (tmp_path / 'retrieval_results.json').exists()
+    assert (tmp_path / 'retrieval_results.json.corrupt').read_text() == '{"conv-1": {"que'
+    assert log_path.read_text() == ''
+
+
+def test_retrieval_results_fold_across_turns(tmp_path, monkeypatch):
+    agent_dir = tmp_path / 'alice' / 'AGENTS' / 'Demo Agent'
+    agent_dir.mkdir(parents=True)
+    log_path = str(agent_dir / 'retrieval_results.jsonl')
+
+    def save(conversation_id, results):
+        retrieval_engine.save_retrieval_results_bulk(
+            str(tmp_path), 'alice', 'Demo Agent', conversation_id,
+            {query: ([_chunk(text) for text in semantic], [_chunk(text) for text in keyword])
+             for query, (semantic, keyword) in results.items()})
+
+    save("conv-1", {"q1": (["a"], ["b"]), "q2": (["c"], [])})
+    save("conv-2", {"q1": (["x"], ["y"])})
+    # A later turn asks q1 again: its newer results win
+    save("conv-1", {"q1": (["d"], ["e", "f"]), "q3": ([], ["g"])})
+
+    expected = {
+        "conv-1": {"q1": _entry(["d"], ["e", "f"]), "q2": _entry(["c"], []), "q3": _entry([], ["g"])},
+        "conv-2": {"q1": _entry(["x"], ["y"])},
+    }
+    assert retrieval_engine.load_retrieval_results(log_path) == expected
+
+    # Once superseded records make up most of the log, compacting them away leaves the same fold
+    monkeypatch.setattr(retrieval_engine, 'RETRIEVAL_COMPACT_MIN_LINES', 0)
+    for _ in range(4):
+        save("conv-1", {"q1": (["d"], ["e", "f"])})
+    assert len(open(log_path).read().splitlines()) == 9
+    assert retrieval_engine.load_retrieval_results(log_path) == expected
+    assert len(open(log_path).read().splitlines()) == 4
+    assert retrieval_engine.load_retrieval_results(log_path) == expected